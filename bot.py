@@ -17,6 +17,8 @@ import discord
 import asyncio
 
 from pcbot import utils, config
+from pcbot.tasks import TaskSupervisor
+from pcbot.ratelimit import RateLimiter
 import plugins
 
 # Sets the version to enable accessibility for other modules
@@ -30,6 +32,10 @@ class Client(discord.Client):
         super().__init__(**kwargs)
         self.time_started = datetime.utcnow()
         self.last_deleted_messages = []
+        self.supervisor = TaskSupervisor(self.loop)  # Runs every command and plugin event listener
+        self.rate_limiter = RateLimiter()
+        self._app_info = None
+        self._app_info_updated = None
 
     async def _handle_event(self, func, event, *args, **kwargs):
         """ Handle the event dispatched. """
@@ -71,7 +77,33 @@ class Client(discord.Client):
                 # Same goes for messages sent by ourselves. Naturally this requires func.bot == True
                 if is_self and not func.self:
                     continue
-                client.loop.create_task(self._handle_event(func, event, *args, **kwargs))
+                # Skip listeners whose filters the event doesn't pass, without creating a task
+                if not plugins.passes_filters(func, *args, **kwargs):
+                    continue
+                self.supervisor.submit(self._handle_event(func, event, *args, **kwargs), event_server_id(args))
+
+    async def get_application_info(self, refresh: bool=False):
+        """ Return the cached application info, fetching it when it's missing or older than
+        app_info_interval. A stale cache is returned when the new info can't be fetched.
+
+        :param refresh: always fetch the application info. """
+        now = datetime.utcnow()
+        if refresh or self._app_info is None or (now - self._app_info_updated).total_seconds() >= app_info_interval:
+            try:
+                self._app_info = await self.application_info()
+            except discord.errors.HTTPException:
+                if self._app_info is None:
+                    raise
+                logging.warning("Could not refresh the application info, using the cached info")
+            else:
+                self._app_info_updated = now
+
+        return self._app_info
+
+    async def logout(self):
+        """ Override to cancel every running command and event listener before logging out. """
+        self.supervisor.cancel_all()
+        await super().logout()
 
     async def send_file(self, destination, fp, *, filename=None, content=None, tts=False):
         """ Override send_file to notify the server when an attachment could not be sent. """
@@ -108,6 +140,7 @@ class Client(discord.Client):
 # Setup our client
 client = Client(loop=asyncio.ProactorEventLoop() if sys.platform == "win32" else None)
 autosave_interval = 60 * 30
+app_info_interval = 60 * 60 * 6  # The application info, e.g the owner, rarely changes
 
 
 async def autosave():
@@ -118,6 +151,15 @@ async def autosave():
         logging.debug("Plugins saved")
 
 
+def event_server_id(args: tuple):
+    """ Return the id of the server an event's first argument belongs to, or None. """
+    if not args:
+        return None
+
+    server = args[0] if isinstance(args[0], discord.Server) else getattr(args[0], "server", None)
+    return server.id if server is not None else None
+
+
 def log_message(message: discord.Message, prefix: str=""):
     """ Logs a command/message. """
     logging.info("{prefix}@{author}{server} -> {content}".format(
@@ -130,8 +172,6 @@ def log_message(message: discord.Message, prefix: str=""):
 
 async def execute_command(command: plugins.Command, message: discord.Message, *args, **kwargs):
     """ Execute a command and send any AttributeError exceptions. """
-    app_info = await client.application_info()
-
     try:
         await command.function(message, *args, **kwargs)
     except AssertionError as e:
@@ -141,8 +181,14 @@ async def execute_command(command: plugins.Command, message: discord.Message, *a
         if utils.is_owner(message.author) and config.owner_error:
             await client.say(message, utils.format_code(traceback.format_exc()))
         else:
+            # The owner is only looked up here, so that commands don't wait for the application info
+            try:
+                owner = (await client.get_application_info()).owner
+            except discord.errors.HTTPException:
+                owner = "the bot owner"
+
             await client.say(message, "An error occurred while executing this command. If the error persists, "
-                                       "please send a PM to {}.".format(app_info.owner))
+                                       "please send a PM to {}.".format(owner))
 
 
 def default_self(anno, default, message: discord.Message):
@@ -369,6 +415,9 @@ async def on_ready():
                  "{0.user} ({0.user.id})\n".format(client) +
                  "-" * len(client.user.id))
 
+    # Cache the application info, which is needed when reporting errors and in bot_info
+    await client.get_application_info(refresh=True)
+
 
 @client.event
 async def on_message(message: discord.Message):
@@ -401,19 +450,39 @@ async def on_message(message: discord.Message):
     if not command:
         return
 
+    # Rate limit the command before parsing it, as parsing may download files
+    cost = 0
+    limit_key = (message.author.id, message.server.id if message.server else None)
+    if not utils.is_owner(message.author):
+        cost = plugins.get_sub_command(command, *cmd_args[1:]).cost
+        wait = client.rate_limiter.consume(*limit_key, cost, command.name)
+        if wait:
+            if client.rate_limiter.should_notify(message.author.id):
+                await client.say(message, "**You're using commands too quickly.** Try again in {:.0f}s.".format(
+                    max(wait, 1)))
+            return
+
     # Parse the command with the user's arguments
     try:
         parsed_command, args, kwargs = await parse_command(command, cmd_args, message)
     except AssertionError as e:  # Return any feedback given from the command via AssertionError, or the command help
         await client.send_message(message.channel, str(e) or utils.format_help(command, no_subcommand=True))
         log_message(message)
-        return
+        parsed_command = None
 
+    # Commands that only sent their usage never ran, so they don't cost anything
     if not parsed_command:
+        if cost:
+            client.rate_limiter.refund(*limit_key, cost, command.name)
         return
 
     log_message(message)
-    client.loop.create_task(execute_command(parsed_command, message, *args, **kwargs))  # Run command
+    coro = execute_command(parsed_command, message, *args, **kwargs)
+    if not client.supervisor.submit(coro, message.server.id if message.server else None):  # Run command
+        if cost:
+            client.rate_limiter.refund(*limit_key, cost, command.name)
+        if client.supervisor.overflow == "reject":
+            await client.say(message, "**I'm too busy to run your command right now. Please try again later.**")
 
     # Log time spent parsing the command
     stop_time = datetime.now()
@@ -466,12 +535,24 @@ def main():
     bot_meta = config.Config("bot_meta", pretty=True, data=dict(
         name="PCBOT",
         command_prefix=config.command_prefix,
-        display_owner_error_in_chat=False
+        display_owner_error_in_chat=False,
+        max_tasks=client.supervisor.max_running,
+        max_tasks_per_server=client.supervisor.max_running_per_server,
+        max_queued_tasks=client.supervisor.max_queued,
+        max_queued_tasks_per_server=client.supervisor.max_queued_per_server,
+        task_overflow=client.supervisor.overflow
     ))
     config.name = bot_meta.data["name"]
     config.command_prefix = bot_meta.data["command_prefix"]
     config.owner_error = bot_meta.data["display_owner_error_in_chat"]
 
+    # Setup the limits of commands and event listeners running at once
+    client.supervisor = TaskSupervisor(client.loop, max_running=bot_meta.data["max_tasks"],
+                                       max_running_per_server=bot_meta.data["max_tasks_per_server"],
+                                       max_queued=bot_meta.data["max_queued_tasks"],
+                                       max_queued_per_server=bot_meta.data["max_queued_tasks_per_server"],
+                                       overflow=bot_meta.data["task_overflow"])
+
     # Set the client for the plugins to use
     plugins.set_client(client)
     utils.set_client(client)
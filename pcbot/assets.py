@@ -0,0 +1,105 @@
+""" Lazy loading of the asset files used by plugins.
+
+An AssetStore only lists the files of an asset directory when created,
+and reads a file the first time it is needed. When the directory has
+been packed with build_pack(), the files are read from the memory-mapped
+pack instead, which saves opening a file for every asset.
+
+Packs are built from the command line:
+
+    python -m pcbot.assets plugins/twemoji21lib plugins/pokedexlib/sprites
+
+A pack starts with pack_magic and the length of the index, followed by
+the JSON index of {file name: [offset, size]} and the content of every
+file, where offsets start at the end of the index. Packs must be built
+again whenever the asset files change.
+"""
+
+import json
+import mmap
+import os
+import struct
+import sys
+from collections.abc import Mapping
+
+
+pack_magic = b"PCBPACK1"
+pack_header = struct.Struct("<8sI")
+
+
+def pack_path(path: str):
+    """ Return the path of the pack of an asset directory. """
+    return path.rstrip("/\\") + ".pack"
+
+
+def build_pack(path: str):
+    """ Pack every file in an asset directory into a single file next to it.
+
+    :returns: the path of the pack. """
+    files = sorted(file for file in os.listdir(path) if os.path.isfile(os.path.join(path, file)))
+
+    # The offsets are relative to the end of the index
+    index, offset = {}, 0
+    for file in files:
+        size = os.path.getsize(os.path.join(path, file))
+        index[file] = [offset, size]
+        offset += size
+    index_bytes = json.dumps(index, separators=(",", ":")).encode("utf-8")
+
+    filename = pack_path(path)
+    with open(filename + ".tmp", "wb") as f:
+        f.write(pack_header.pack(pack_magic, len(index_bytes)))
+        f.write(index_bytes)
+        for file in files:
+            with open(os.path.join(path, file), "rb") as asset:
+                f.write(asset.read())
+    os.replace(filename + ".tmp", filename)
+
+    return filename
+
+
+class AssetStore(Mapping):
+    """ Read-only mapping of asset keys to the bytes of their files. """
+    def __init__(self, path: str, key=lambda file: file.split(".")[0]):
+        """
+        :param path: the asset directory.
+        :param key: a function returning the key of a file name. By default, the name without the extension. """
+        self.path = path
+        self.pack = None
+        self.files = {}  # Key -> file name, or (offset, size) in the pack
+
+        filename = pack_path(path)
+        if os.path.exists(filename):
+            with open(filename, "rb") as f:
+                self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            magic, length = pack_header.unpack_from(self.pack)
+            assert magic == pack_magic, "{} is not an asset pack.".format(filename)
+            start = pack_header.size + length
+            index = json.loads(self.pack[pack_header.size:start].decode("utf-8"))
+            self.files = {key(file): (start + offset, size) for file, (offset, size) in index.items()}
+        else:
+            self.files = {key(file): file for file in os.listdir(path)}
+
+    def __getitem__(self, key):
+        location = self.files[key]
+        if self.pack is not None:
+            offset, size = location
+            return self.pack[offset:offset + size]
+
+        with open(os.path.join(self.path, location), "rb") as f:
+            return f.read()
+
+    def __contains__(self, key):
+        return key in self.files
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+
+if __name__ == "__main__":
+    for directory in sys.argv[1:]:
+        print("Packed {} into {}".format(directory, build_pack(directory)))
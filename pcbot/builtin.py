@@ -22,6 +22,8 @@ lambdas = Config("lambdas", data={})
 lambda_config = Config("lambda-config", data=dict(imports=[], blacklist=[]))
 
 code_globals = {}
+lambda_code = {}  # Triggers -> compiled code defining lambda_session(), or the SyntaxError raised when compiling
+lambda_triggers = set()  # The triggers of every lambda that is not disabled
 
 
 @plugins.command(name="help", aliases="commands")
@@ -259,6 +261,8 @@ async def add(message: discord.Message, trigger: str, python_code: Annotate.Code
     """ Add a command that runs the specified python code. """
     lambdas.data[trigger] = python_code
     lambdas.save()
+    compile_lambda(trigger)
+    update_lambda_triggers()
     await client.say(message, "Command `{}` set.".format(trigger))
 
 
@@ -271,6 +275,8 @@ async def remove(message: discord.Message, trigger: str):
     # The command specified exists and we remove it
     del lambdas.data[trigger]
     lambdas.save()
+    lambda_code.pop(trigger, None)
+    update_lambda_triggers()
     await client.say(message, "Command `{}` removed.".format(trigger))
 
 
@@ -282,6 +288,7 @@ async def enable(message: discord.Message, trigger: str):
     if trigger in lambda_config.data["blacklist"]:
         lambda_config.data["blacklist"].remove(trigger)
         lambda_config.save()
+        update_lambda_triggers()
         await client.say(message, "Command `{}` enabled.".format(trigger))
     else:
         assert trigger in lambdas.data, "Command `{}` does not exist.".format(trigger)
@@ -298,6 +305,7 @@ async def disable(message: discord.Message, trigger: str):
     if trigger not in lambda_config.data["blacklist"]:
         lambda_config.data["blacklist"].append(trigger)
         lambda_config.save()
+        update_lambda_triggers()
         await client.say(message, "Command `{}` disabled.".format(trigger))
     else:
         assert trigger in lambdas.data, "Command `{}` does not exist.".format(trigger)
@@ -306,6 +314,36 @@ async def disable(message: discord.Message, trigger: str):
         await client.say(message, "Command `{}` is already disabled.".format(trigger))
 
 
+def compile_lambda(trigger: str):
+    """ Compile the code of a lambda into code defining an async function, so that
+    we can await it using the result of eval. """
+    python_code = "async def lambda_session():\n    " + "\n    ".join(lambdas.data[trigger].split("\n"))
+    try:
+        lambda_code[trigger] = compile(python_code, "<string>", "exec")
+    except SyntaxError as e:
+        lambda_code[trigger] = e
+
+
+def update_lambda_triggers():
+    """ Update the set of triggers of lambdas that are not disabled. """
+    lambda_triggers.clear()
+    lambda_triggers.update(trigger for trigger in lambdas.data if trigger not in lambda_config.data["blacklist"])
+
+
+def get_lambda_trigger(content: str):
+    """ Return the first argument of a message when it might be a lambda trigger, or None.
+    The message is only split with utils.split() when the first word is quoted or escaped. """
+    words = content.split(None, 1)
+    if not words:
+        return None
+
+    if any(c in words[0] for c in "\"`\\"):
+        args = utils.split(content)
+        return args[0] if args else None
+
+    return words[0]
+
+
 def import_module(module: str, attr: str=None):
     """ Remotely import a module or attribute from module into code_globals. """
     # The name of the module in globals
@@ -378,6 +416,46 @@ async def ping(message: discord.Message):
     await client.edit_message(first_message, "Pong! `{elapsed:.4f}ms`".format(elapsed=time_elapsed))
 
 
+@plugins.command(hidden=True)
+@utils.owner
+async def tasks(message: discord.Message):
+    """ Display the number of commands and event listeners running or queued. """
+    supervisor = client.supervisor
+    busiest = sorted(supervisor.running_per_server.items(), key=lambda item: item[1], reverse=True)[:5]
+    servers = ", ".join("{} ({})".format(getattr(client.get_server(server_id), "name", server_id), running)
+                        for server_id, running in busiest)
+
+    await client.say(message, "**Tasks:** {running}/{max_running} running, {queued}/{max_queued} queued "
+                              "({max_seen} at most), {started} started, {dropped} dropped ({overflow}).\n"
+                              "**Busiest servers:** {servers}".format(
+        running=len(supervisor.running), max_running=supervisor.max_running, queued=len(supervisor.queue),
+        max_queued=supervisor.max_queued, max_seen=supervisor.max_seen_queued, started=supervisor.started,
+        dropped=supervisor.dropped, overflow=supervisor.overflow, servers=servers or "None"))
+
+
+@plugins.command(hidden=True)
+@utils.owner
+async def ratelimits(message: discord.Message, num: utils.int_range(f=1, t=20)=5):
+    """ Display the users and servers that recently used the most command tokens. """
+    limiter = client.rate_limiter
+
+    def format_top(group, get_name):
+        return "\n".join("{:<24} {:>6g} tokens, {} limited, {:.1f} left".format(
+            get_name(key)[:24], bucket.consumed, bucket.limited, bucket.tokens) for key, bucket in group.top(num))
+
+    def user_name(user_id):
+        return str(discord.utils.get(client.get_all_members(), id=user_id) or user_id)
+
+    users = format_top(limiter.users, user_name)
+    servers = format_top(limiter.servers, lambda server_id: getattr(client.get_server(server_id), "name", server_id))
+    commands = format_top(limiter.commands, lambda key: "{} {}".format(user_name(key[0]), key[1]))
+    await client.say(message, "**Users** ({} tracked, {:g} tokens / {:.1f}s):{}**Servers** ({} tracked):{}"
+                              "**Commands** ({} tracked):{}".format(
+        len(limiter.users), limiter.users.capacity, 1 / limiter.users.rate, utils.format_code(users or "None"),
+        len(limiter.servers), utils.format_code(servers or "None"),
+        len(limiter.commands), utils.format_code(commands or "None")))
+
+
 async def get_changelog(num: int):
     """ Get the latest commit messages from PCBOT. """
     since = datetime.utcnow() - timedelta(days=7)
@@ -409,7 +487,7 @@ async def get_changelog(num: int):
 @plugins.command(name=config.name.lower())
 async def bot_info(message: discord.Message):
     """ Display basic information. """
-    app_info = await client.application_info()
+    app_info = await client.get_application_info()
 
     await client.say(message, "**{ver}** - **{name}** ```elm\n"
                               "Owner   : {owner}\n"
@@ -455,39 +533,43 @@ def init():
         lambda_config.data["imports"].remove([module, attr])
         lambda_config.save()
 
+    # Compile every lambda
+    for trigger in lambdas.data:
+        compile_lambda(trigger)
+    update_lambda_triggers()
+
 
-@plugins.event()
+@plugins.event(check=lambda message: get_lambda_trigger(message.content) in lambda_triggers)
 async def on_message(message: discord.Message):
     """ Perform lambda commands. """
-    args = utils.split(message.content)
-
     # Check if the command is a lambda command and is not disabled (in the blacklist)
-    if args[0] in lambdas.data and args[0] not in lambda_config.data["blacklist"]:
+    trigger = get_lambda_trigger(message.content)
+    if trigger in lambda_triggers:
+        args = utils.split(message.content)
+
         def arg(i, default=0):
             if len(args) > i:
                 return args[i]
             else:
                 return default
 
-        code_globals.update(dict(arg=arg, args=args, message=message, client=client,
-                                 author=message.author, server=message.server, channel=message.channel))
-        python_code = lambdas.data[args[0]]
-
-        # Create an async function so that we can await it using the result of eval
-        python_code = "async def lambda_session():\n    " + "\n    ".join(line for line in python_code.split("\n"))
-        try:
-            exec(python_code, code_globals)
-        except SyntaxError as e:
+        python_code = lambda_code[trigger]
+        if isinstance(python_code, SyntaxError):
             if utils.is_owner(message.author):
-                await client.say(message, "```" + utils.format_syntax_error(e) + "```")
+                await client.say(message, "```" + utils.format_syntax_error(python_code) + "```")
             else:
                 logging.warning("An exception occurred when parsing lambda command:"
-                                "\n{}".format(utils.format_syntax_error(e)))
+                                "\n{}".format(utils.format_syntax_error(python_code)))
             return True
 
+        # Every invocation defines the function in its own copy of the globals, so that lambdas can run at once
+        session_globals = dict(code_globals, arg=arg, args=args, message=message, client=client,
+                               author=message.author, server=message.server, channel=message.channel)
+        exec(python_code, session_globals)
+
         # Execute the command
         try:
-            await eval("lambda_session()", code_globals)
+            await session_globals["lambda_session"]()
         except AssertionError as e:  # Send assertion errors to the core module
             raise AssertionError(e)
         except Exception as e:
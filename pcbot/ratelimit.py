@@ -0,0 +1,138 @@
+""" Token bucket rate limiting of commands.
+
+Every user, every server and every command of a user has a bucket of
+tokens, which refills at a steady rate up to its capacity. A command costs
+tokens from the buckets of its author, its server and the author's use of
+the command, where the cost is set per command with plugins.command(cost=...).
+
+Buckets are kept in least recently used order, so that buckets idle long
+enough to be full again are evicted from the front without scanning them
+all. An evicted bucket is the same as a new one, except for its statistics.
+"""
+
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """ The tokens of a single user or server. """
+    __slots__ = ("tokens", "updated", "consumed", "limited", "notified")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+        self.consumed = 0  # Tokens consumed since the bucket was created
+        self.limited = 0  # Commands refused since the bucket was created
+        self.notified = False  # Whether the user was told they're limited since their last accepted command
+
+
+class BucketGroup:
+    """ Buckets of one kind, e.g every user's. """
+    def __init__(self, capacity: float, rate: float):
+        """
+        :param capacity: the maximum number of tokens in a bucket.
+        :param rate: the number of tokens refilled per second. """
+        self.capacity = capacity
+        self.rate = rate
+        self.buckets = OrderedDict()  # Key -> TokenBucket, least recently used first
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def get(self, key: str, now: float):
+        """ Return the refilled bucket of a key, and mark it as the most recently used. """
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.capacity, now)
+        else:
+            bucket.tokens = min(self.capacity, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+            self.buckets.move_to_end(key)
+
+        return bucket
+
+    def wait_time(self, bucket: TokenBucket, cost: float):
+        """ Return the seconds until the bucket has enough tokens for the cost. """
+        return max(0.0, (min(cost, self.capacity) - bucket.tokens) / self.rate)
+
+    def evict(self, now: float):
+        """ Remove the buckets that have been idle long enough to be full. """
+        idle_time = self.capacity / self.rate
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if now - bucket.updated < idle_time:
+                break
+
+            del self.buckets[key]
+
+    def top(self, num: int):
+        """ Return a list of the num (key, bucket) that consumed the most tokens. """
+        return sorted(self.buckets.items(), key=lambda item: item[1].consumed, reverse=True)[:num]
+
+
+class RateLimiter:
+    """ Rate limiter of commands by user, by server and by command of a user. """
+    def __init__(self, user_capacity: float=10, user_rate: float=2 / 3, server_capacity: float=60,
+                 server_rate: float=2, command_capacity: float=6, command_rate: float=1 / 3):
+        """
+        :param user_capacity: the maximum tokens of a user, i.e the largest burst of commands.
+        :param user_rate: the tokens refilled per second for a user.
+        :param server_capacity: the maximum tokens of a server.
+        :param server_rate: the tokens refilled per second for a server.
+        :param command_capacity: the maximum tokens of a user's use of a single command.
+        :param command_rate: the tokens refilled per second for a user's use of a single command. """
+        self.users = BucketGroup(user_capacity, user_rate)
+        self.servers = BucketGroup(server_capacity, server_rate)
+        self.commands = BucketGroup(command_capacity, command_rate)
+
+    def _buckets(self, user_id: str, server_id: str, command: str, now: float):
+        """ Return a list of (group, bucket) charged for a command. """
+        buckets = [(self.users, self.users.get(user_id, now))]
+        if server_id is not None:
+            buckets.append((self.servers, self.servers.get(server_id, now)))
+        if command is not None:
+            buckets.append((self.commands, self.commands.get((user_id, command), now)))
+        return buckets
+
+    def consume(self, user_id: str, server_id: str=None, cost: float=1, command: str=None):
+        """ Take the cost of a command from the buckets of the user, the server and
+        the user's use of the command. Nothing is taken unless every bucket can afford
+        it. A cost larger than a bucket's capacity costs the entire bucket.
+
+        :param server_id: the id of the server, or None in private messages.
+        :param command: the name of the command, or None to not limit commands separately.
+        :returns: 0 when the command may run, otherwise the seconds to wait before it can. """
+        now = time.monotonic()
+        for group in (self.users, self.servers, self.commands):
+            group.evict(now)
+
+        buckets = self._buckets(user_id, server_id, command, now)
+        wait = max(group.wait_time(bucket, cost) for group, bucket in buckets)
+        if wait > 0:
+            for _, bucket in buckets:
+                bucket.limited += 1
+            return wait
+
+        for group, bucket in buckets:
+            bucket.tokens -= min(cost, group.capacity)
+            bucket.consumed += cost
+        buckets[0][1].notified = False
+        return 0
+
+    def refund(self, user_id: str, server_id: str=None, cost: float=1, command: str=None):
+        """ Give back the cost of a command that was consumed but never ran, e.g
+        when its arguments were invalid. The arguments are the same as consume(). """
+        now = time.monotonic()
+        for group, bucket in self._buckets(user_id, server_id, command, now):
+            bucket.tokens = min(group.capacity, bucket.tokens + min(cost, group.capacity))
+            bucket.consumed -= cost
+
+    def should_notify(self, user_id: str):
+        """ Return whether to tell a limited user that they're limited. Users are only
+        told once until their next accepted command, so that spam doesn't get a reply each. """
+        bucket = self.users.buckets.get(user_id)
+        if bucket is None or bucket.notified:
+            return False
+
+        bucket.notified = True
+        return True
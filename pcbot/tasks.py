@@ -0,0 +1,156 @@
+""" Bounded execution of command and event tasks.
+
+The TaskSupervisor caps the number of tasks running at once, both in
+total and per server. Tasks over the caps wait in a bounded queue, and
+when the queue is full the overflow policy decides what happens:
+
+    drop    the new task is dropped silently.
+    reject  the new task is dropped, and submit() returns False so that
+            the caller can give feedback.
+    shed    the oldest queued task is dropped to make room for the new one.
+"""
+
+import asyncio
+import logging
+from collections import deque, defaultdict
+
+overflow_policies = ("drop", "reject", "shed")
+
+
+def current_task(loop: asyncio.AbstractEventLoop):
+    """ Return the task running in the loop, or None. """
+    if hasattr(asyncio, "current_task"):
+        return asyncio.current_task(loop)
+
+    return asyncio.Task.current_task(loop=loop)
+
+
+class TaskSupervisor:
+    """ Runs coroutines as tasks with limits on concurrency. """
+    def __init__(self, loop: asyncio.AbstractEventLoop, max_running: int=256, max_running_per_server: int=32,
+                 max_queued: int=1024, max_queued_per_server: int=128, overflow: str="reject"):
+        """
+        :param max_running: the maximum number of tasks running at once.
+        :param max_running_per_server: the maximum number of tasks of a single server running at once.
+            Tasks without a server, e.g from private messages, only count towards max_running.
+        :param max_queued: the maximum number of tasks waiting to run.
+        :param max_queued_per_server: the maximum number of tasks of a single server waiting to run, so
+            that a flood in one server can't fill the queue for everyone.
+        :param overflow: what to do when the queue is full, one of overflow_policies. """
+        assert overflow in overflow_policies, "overflow must be one of {}".format(", ".join(overflow_policies))
+        self.loop = loop
+        self.max_running = max_running
+        self.max_running_per_server = max_running_per_server
+        self.max_queued = max_queued
+        self.max_queued_per_server = max_queued_per_server
+        self.overflow = overflow
+
+        self.running = set()  # Running tasks
+        self.running_per_server = defaultdict(int)  # Server id -> number of running tasks
+        self.queue = deque()  # Tuples of (coroutine, server id) waiting to run
+        self.queued_per_server = defaultdict(int)  # Server id -> number of queued tasks
+        self.overflowing = False  # Whether tasks were dropped since the queue was last below its limits
+
+        # Metrics
+        self.started = 0
+        self.dropped = 0
+        self.max_seen_queued = 0
+
+    def __len__(self):
+        """ The number of tasks running or queued. """
+        return len(self.running) + len(self.queue)
+
+    def _can_start(self, server_id: str):
+        if len(self.running) >= self.max_running:
+            return False
+
+        return server_id is None or self.running_per_server.get(server_id, 0) < self.max_running_per_server
+
+    def _start(self, coro, server_id: str):
+        task = self.loop.create_task(coro)
+        self.running.add(task)
+        if server_id is not None:
+            self.running_per_server[server_id] += 1
+
+        self.started += 1
+        task.add_done_callback(lambda task: self._task_done(task, server_id))
+
+    def _drop(self, coro):
+        """ Close a coroutine that will never run, so that it's not reported as never awaited. """
+        coro.close()
+        self.dropped += 1
+
+    def _unqueue(self, index: int):
+        """ Remove a task from the queue and return it as (coroutine, server id). """
+        coro, server_id = self.queue[index]
+        del self.queue[index]
+        if server_id is not None:
+            self.queued_per_server[server_id] -= 1
+            if self.queued_per_server[server_id] <= 0:
+                del self.queued_per_server[server_id]
+
+        return coro, server_id
+
+    def submit(self, coro, server_id: str=None):
+        """ Run a coroutine as a task, or queue it when over the limits.
+
+        :param server_id: the id of the server the task is for, or None.
+        :returns: False when the task was dropped by the overflow policy, otherwise True. """
+        # Anything queued is waiting for its own server, so a task that can start doesn't cut in line
+        if self._can_start(server_id):
+            self._start(coro, server_id)
+            return True
+
+        server_full = server_id is not None and self.queued_per_server.get(server_id, 0) >= self.max_queued_per_server
+        if server_full or len(self.queue) >= self.max_queued:
+            # Only log once every time the queue fills up, as there may be thousands of tasks dropped
+            if not self.overflowing:
+                logging.warning("Task queue is full ({} tasks, {} from server {}), dropping tasks ({})".format(
+                    len(self.queue), self.queued_per_server.get(server_id, 0), server_id, self.overflow))
+                self.overflowing = True
+
+            if self.overflow == "shed":
+                # Make room by dropping the oldest task of the server when it's the server's queue that's full
+                index = next(i for i, (_, queued_server_id) in enumerate(self.queue)
+                             if not server_full or queued_server_id == server_id)
+                self._drop(self._unqueue(index)[0])
+            else:
+                self._drop(coro)
+                return False
+
+        self.queue.append((coro, server_id))
+        if server_id is not None:
+            self.queued_per_server[server_id] += 1
+        self.max_seen_queued = max(self.max_seen_queued, len(self.queue))
+        return True
+
+    def _task_done(self, task: asyncio.Task, server_id: str):
+        self.running.discard(task)
+        if server_id is not None:
+            self.running_per_server[server_id] -= 1
+            if self.running_per_server[server_id] <= 0:
+                del self.running_per_server[server_id]
+
+        self._start_queued()
+
+    def _start_queued(self):
+        """ Start queued tasks in order, skipping tasks of servers that are at their limit. """
+        index = 0
+        while index < len(self.queue) and len(self.running) < self.max_running:
+            if self._can_start(self.queue[index][1]):
+                self._start(*self._unqueue(index))
+            else:
+                index += 1
+
+        if len(self.queue) < self.max_queued:
+            self.overflowing = False
+
+    def cancel_all(self):
+        """ Drop every queued task and cancel every running task, except the task calling this. """
+        while self.queue:
+            self._drop(self._unqueue(0)[0])
+
+        current = current_task(self.loop)
+        for task in list(self.running):
+            if task is not current:
+                task.cancel()
@@ -18,7 +18,7 @@ plugins = {}
 events = defaultdict(list)
 Command = namedtuple("Command", "name name_prefix  aliases "
                                 "usage description function parent sub_commands depth hidden error pos_check "
-                                "disabled_pm doc_args")
+                                "disabled_pm doc_args cost")
 lengthy_annotations = (Annotate.Content, Annotate.CleanContent, Annotate.LowerContent,
                        Annotate.LowerCleanContent, Annotate.Code)
 argument_format = "{open}{name}{suffix}{close}"
@@ -99,6 +99,8 @@ def command(**options):
         pos_check   : func / bool : An optional check function for positional arguments, eg: pos_check=lambda s: s
                                     When this attribute is a bool and True, force positional arguments.
         doc_args    : dict        : Arguments to send to the docstring under formatting.
+        cost        : float       : The tokens taken from the rate limits of the user and server, see pcbot.ratelimit.
+                                    Subcommands use the cost of their parent by default, otherwise the default is 1.
     """
     def decorator(func):
         # Make sure the first parameter in the function is a message object
@@ -119,6 +121,7 @@ def command(**options):
         description = options.get("description") or func.__doc__ or "Undocumented."
         disabled_pm = options.get("disabled_pm", False)
         doc_args = options.get("doc_args", dict())
+        cost = options.get("cost", parent.cost if parent is not None else 1)
 
         # Parse aliases
         if type(aliases) is str:
@@ -169,7 +172,7 @@ def command(**options):
         # Create our command
         cmd = Command(name=name, aliases=aliases, usage=usage, name_prefix=name_prefix, description=description,
                       function=func, parent=parent, sub_commands=[], depth=depth, hidden=hidden, error=error,
-                      pos_check=pos_check, disabled_pm=disabled_pm, doc_args=doc_args)
+                      pos_check=pos_check, disabled_pm=disabled_pm, doc_args=doc_args, cost=cost)
 
         # If the command has a parent (is a subcommand)
         if parent:
@@ -193,8 +196,19 @@ def command(**options):
     return decorator
 
 
-def event(name=None, bot=False, self=False):
-    """ Decorator to add event listeners in plugins. """
+def event(name=None, bot=False, self=False, prefix=None, guild_only: bool=False, channels=None, check=None):
+    """ Decorator to add event listeners in plugins.
+
+    The listener is only called when the event passes every given filter. Filters
+    are checked when the event is dispatched, so that listeners are never started
+    for events they would ignore anyway. The message filters apply to the message
+    events, and check the last message argument, e.g the edited message in on_message_edit.
+
+    :param prefix: a string or a tuple of strings. Only call the listener when the message starts with one.
+    :param guild_only: only call the listener for messages sent in a server.
+    :param channels: only call the listener for messages sent in one of these channel ids.
+    :param check: a function taking the event's arguments and returning whether to call the listener.
+        It's called in dispatch, so it must be fast and can not be a coroutine. """
     def decorator(func):
         event_name = name or func.__name__
 
@@ -205,11 +219,20 @@ def event(name=None, bot=False, self=False):
         if self and not bot and client.user.bot:
             logging.warning("self=True has no effect in event {}. Consider setting bot=True".format(func.__name__))
 
+        if (prefix is not None or guild_only or channels is not None) and not event_name.startswith("on_message"):
+            raise ValueError("prefix, guild_only and channels only apply to message events, not {}".format(event_name))
+
         # Set the bot attribute, which determines whether the function will be triggered by messages from bot accounts
         # The self attribute denotes if own messages will be logged
         setattr(func, "bot", bot)
         setattr(func, "self", self)
 
+        # Set the filters checked by passes_filters()
+        setattr(func, "prefix", prefix)
+        setattr(func, "guild_only", guild_only)
+        setattr(func, "channels", frozenset(channels) if channels is not None else None)
+        setattr(func, "check", check)
+
         # Register our event
         events[event_name].append(func)
         return func
@@ -217,6 +240,27 @@ def event(name=None, bot=False, self=False):
     return decorator
 
 
+def passes_filters(func, *args, **kwargs):
+    """ Return whether an event passes the filters of an event listener. See event(). """
+    if func.prefix is not None or func.guild_only or func.channels is not None:
+        message = args[-1]  # The newest message, e.g after in on_message_edit(before, after)
+        if func.prefix is not None and not message.content.startswith(func.prefix):
+            return False
+        if func.guild_only and message.channel.is_private:
+            return False
+        if func.channels is not None and message.channel.id not in func.channels:
+            return False
+
+    if func.check is not None:
+        try:
+            return bool(func.check(*args, **kwargs))
+        except Exception as e:  # An exception here would otherwise stop every other listener
+            logging.error("Event check of {} failed:\n{}".format(func.__name__, format_exception(e)))
+            return False
+
+    return True
+
+
 def argument(format=argument_format, *, pass_message=False, allow_spaces=False):
     """ Decorator for easily setting custom argument usage formats. """
     def decorator(func):
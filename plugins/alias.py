@@ -7,6 +7,7 @@ import discord
 import asyncio
 
 from pcbot import Config, Annotate, config, utils
+from plugins.aliaslib.matcher import AliasMatcher
 import plugins
 client = plugins.client  # type: discord.Client
 
@@ -20,6 +21,15 @@ alias_desc = \
     "`-delete-message` removes the original message. This option can not be mixed with the `-anywhere` option.\n" \
 
 aliases = Config("user_alias", data={})
+matchers = {}  # User ids -> AliasMatcher, created when the user next sends a message after changing their aliases
+
+
+def get_matcher(user_id: str):
+    """ Return the alias matcher of a user, creating it when necessary. """
+    if user_id not in matchers:
+        matchers[user_id] = AliasMatcher(aliases.data[user_id])
+
+    return matchers[user_id]
 
 
 @plugins.command(description=alias_desc, pos_check=lambda s: s.startswith("-"))
@@ -40,6 +50,7 @@ async def alias(message: discord.Message, *options: str.lower, trigger: str, tex
         delete_message=delete_message
     )
     aliases.save()
+    matchers.pop(message.author.id, None)
 
     m = "**Alias assigned.** Type `{}`{} to trigger the alias."
     await client.say(message, m.format(trigger, " anywhere in a message" if anywhere else ""))
@@ -61,6 +72,7 @@ async def remove(message: discord.Message, trigger: Annotate.Content):
     if trigger == "*":
         aliases.data[message.author.id] = {}
         aliases.save()
+        matchers.pop(message.author.id, None)
         await client.say(message, "**Removed all aliases.**")
 
     # Check if the trigger is in the would be list (basically checks if trigger is in [] if user is not registered)
@@ -70,33 +82,22 @@ async def remove(message: discord.Message, trigger: Annotate.Content):
     # Trigger is an assigned alias, remove it
     aliases.data[message.author.id].pop(trigger)
     aliases.save()
+    matchers.pop(message.author.id, None)
     await client.say(message, "**Alias `{}` removed.**".format(trigger, message.author))
 
 
-@plugins.event()
+@plugins.event(check=lambda message: message.author.id in aliases.data)
 async def on_message(message: discord.Message):
     success = False
 
     # User alias check
     if message.author.id in aliases.data:
         user_aliases = aliases.data[message.author.id]
+        matched = get_matcher(message.author.id).match(message.content)
 
-        # Check any aliases
+        # Execute the matched aliases in the order they were assigned
         for name, command in user_aliases.items():
-            execute = False
-            msg = message.content
-
-            if not command.get("case_sensitive", False):
-                msg = msg.lower()
-
-            if command.get("anywhere", False):
-                if name in msg:
-                    execute = True
-            else:
-                if msg.startswith(name):
-                    execute = True
-
-            if execute:
+            if name in matched:
                 if command.get("delete_message", False):
                     if message.server.me.permissions_in(message.channel).manage_messages:
                         asyncio.ensure_future(client.delete_message(message))
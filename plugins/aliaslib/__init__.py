@@ -0,0 +1 @@
+""" Library for the alias plugin. """
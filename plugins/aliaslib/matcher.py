@@ -0,0 +1,133 @@
+""" Matching of every alias trigger of a user in a single pass over a message.
+
+    Triggers that must start the message are stored in a prefix trie, and
+    triggers matching anywhere in an Aho-Corasick automaton, so that a
+    message is scanned once no matter how many aliases a user has. Both
+    have a case sensitive and a case insensitive variant, where the latter
+    is searched in the lowercase message.
+
+    Python's string methods beat the automata for users with only a few
+    aliases, so below min_automaton_aliases the triggers are checked one
+    by one instead. """
+
+min_automaton_aliases = 50
+
+
+class Trie:
+    """ Prefix tree of words, where every node is an index into the lists. """
+    def __init__(self, words=()):
+        self.children = [{}]  # Node -> {character: child node}
+        self.words = [None]  # Node -> the word ending at the node, or None
+        for word in words:
+            self.add(word)
+
+    def add(self, word: str):
+        """ Add a word to the tree. """
+        node = 0
+        for char in word:
+            child = self.children[node].get(char)
+            if child is None:
+                child = len(self.children)
+                self.children[node][char] = child
+                self.children.append({})
+                self.words.append(None)
+
+            node = child
+
+        self.words[node] = word
+
+    def prefixes(self, text: str):
+        """ Return the list of words that text starts with. """
+        found = [self.words[0]] if self.words[0] is not None else []
+        node = 0
+        for char in text:
+            node = self.children[node].get(char)
+            if node is None:
+                break
+
+            if self.words[node] is not None:
+                found.append(self.words[node])
+
+        return found
+
+
+class AhoCorasick(Trie):
+    """ Automaton finding every word contained in a text. """
+    def __init__(self, words=()):
+        super().__init__(words)
+
+        # The fail link of a node points to the longest proper suffix of its path that is also in the tree,
+        # and the output of a node lists every word ending at the node, including through fail links
+        self.fail = [0] * len(self.children)
+        self.output = [[word] if word is not None else [] for word in self.words]
+
+        queue = [0]
+        for node in queue:  # Breadth first, so that fail links always point to finished nodes
+            for char, child in self.children[node].items():
+                queue.append(child)
+                if node != 0:
+                    fail = self.fail[node]
+                    while char not in self.children[fail] and fail != 0:
+                        fail = self.fail[fail]
+                    self.fail[child] = self.children[fail].get(char, 0)
+
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def search(self, text: str):
+        """ Return the set of words contained in text. """
+        children, fail, output = self.children, self.fail, self.output
+        found = set(output[0])
+        node = 0
+        for char in text:
+            while char not in children[node] and node != 0:
+                node = fail[node]
+            node = children[node].get(char, 0)
+            if output[node]:
+                found.update(output[node])
+
+        return found
+
+
+class AliasMatcher:
+    """ Matcher of every alias of a user. """
+    def __init__(self, user_aliases: dict):
+        """
+        :param user_aliases: dict of trigger -> alias options, as stored by the alias plugin. """
+        self.few = None  # List of (trigger, anywhere, case_sensitive) when there are too few aliases for the automata
+        if len(user_aliases) < min_automaton_aliases:
+            self.few = [(trigger, command.get("anywhere", False), command.get("case_sensitive", False))
+                        for trigger, command in user_aliases.items()]
+            return
+
+        triggers = {(anywhere, case_sensitive): [] for anywhere in (True, False) for case_sensitive in (True, False)}
+        for trigger, command in user_aliases.items():
+            triggers[(command.get("anywhere", False), command.get("case_sensitive", False))].append(trigger)
+
+        # Only the automata with any triggers are created
+        self.prefix_case = Trie(triggers[(False, True)]) if triggers[(False, True)] else None
+        self.prefix_lower = Trie(triggers[(False, False)]) if triggers[(False, False)] else None
+        self.anywhere_case = AhoCorasick(triggers[(True, True)]) if triggers[(True, True)] else None
+        self.anywhere_lower = AhoCorasick(triggers[(True, False)]) if triggers[(True, False)] else None
+
+    def match(self, content: str):
+        """ Return the set of triggers matching a message. """
+        if self.few is not None:
+            lower = content.lower()
+            return set(trigger for trigger, anywhere, case_sensitive in self.few
+                       if (trigger in (content if case_sensitive else lower) if anywhere
+                           else (content if case_sensitive else lower).startswith(trigger)))
+
+        found = set()
+        if self.prefix_case is not None:
+            found.update(self.prefix_case.prefixes(content))
+        if self.anywhere_case is not None:
+            found.update(self.anywhere_case.search(content))
+
+        if self.prefix_lower is not None or self.anywhere_lower is not None:
+            lower = content.lower()
+            if self.prefix_lower is not None:
+                found.update(self.prefix_lower.prefixes(lower))
+            if self.anywhere_lower is not None:
+                found.update(self.anywhere_lower.search(lower))
+
+        return found
@@ -4,151 +4,58 @@ import discord
 
 import plugins
 from pcbot import Annotate, Config
+from plugins.brainfucklib.engine import compile_brainfuck, brainfuck_chars
+from plugins.brainfucklib.sandbox import Sandbox
 client = plugins.client  # type: discord.Client
 
 
 cfg = Config("brainfuck", data={})  # Keys are names and values are dict with author, code
-max_iterations = 2 ** 17
-brainfuck_chars = "+-><][.,"
+compiled_snippets = {}  # Keys are names and values are tuples of (code, compiled program)
 
+# Programs run in worker processes, each with a CPU and a wall-clock budget in seconds
+brainfuck_workers = 2
+cpu_time, wall_time = 2, 5
+max_message_length = 2000
 
-class Loop:
-    def __init__(self, start, end):
-        self.start = start
-        self.end = end
-        self.pointer = None
-
-    def set_pointer(self, pointer):
-        self.pointer = (pointer.cursor, pointer.value)
-
-    def compare_pointer(self, pointer):
-        if self.pointer is None:
-            return False
-
-        return self.pointer == (pointer.cursor, pointer.value)
-
-
-class TooManyIterations(Exception):
-    pass
-
-
-class InfiniteLoop(Exception):
-    pass
-
-
-class Pointer:
-    cells = 2 ** 15
-    cell_size = 2 ** 8 - 1
-
-    def __init__(self):
-        self.array = [0] * self.cells
-        self.cursor = 0
-
-    @property
-    def value(self):
-        return self.array[self.cursor]
-
-    @value.setter
-    def value(self, value):
-        self.array[self.cursor] = value
-
-    def add(self):
-        self.value += 1
-        if self.value > self.cell_size:
-            self.value = 0
-
-    def sub(self):
-        self.value -= 1
-        if self.value < 0:
-            self.value = self.cell_size
-
-    def right(self):
-        self.cursor += 1
-        if self.cursor >= self.cells:
-            self.cursor = 0
-
-    def left(self):
-        self.cursor -= 1
-        if self.cursor < 0:
-            self.cursor = self.cells - 1
-
-
-def find_loop_end(code: str, start: int):
-    nest = 1
-    for i, c in enumerate(code):
-        if c == "[":
-            nest += 1
-        elif c == "]":
-            nest -= 1
-
-        if nest == 0:
-            return start + i
-
-    raise SyntaxError("{}: Loop never ends!".format(start))
-
-
-def run_brainfuck(code: str, for_input: str=""):
-    pointer = Pointer()
-    input_pointer = Pointer()
-    input_pointer.array[:len(for_input)] = list(ord(c) for c in for_input)
-    loops = []
-
-    i, iterations = 0, 0
-    output = ""
-    while True:
-        char = code[i]
-
-        if char == "+":
-            pointer.add()
-        elif char == "-":
-            pointer.sub()
-        elif char == ">":
-            pointer.right()
-        elif char == "<":
-            pointer.left()
-        elif char == ".":
-            output += chr(pointer.value)
-        elif char == ",":
-            pointer.value = input_pointer.value
-            input_pointer.right()
-            if loops:
-                loops[-1].pointer = None
-        elif char == "[":
-            end = find_loop_end(code[i + 1:], i)
-            loops.append(Loop(start=i, end=end))
-            if pointer.value == 0:
-                i = end
-        elif char == "]":
-            if loops:
-                if loops[-1].compare_pointer(pointer):
-                    raise InfiniteLoop("{}: Pointer value unchanged.".format(loops[-1].start))
-
-                if not pointer.value == 0:
-                    i = loops[-1].start
-                    loops[-1].set_pointer(pointer)
-                else:
-                    del loops[-1]
-
-        i += 1
-        if i >= len(code):
-            return output or "Pointer value: {}".format(pointer.value)
-
-        iterations += 1
-        if iterations >= max_iterations:
-            raise TooManyIterations("Program exceeded maximum number of iterations ({})".format(max_iterations))
-
-
-async def brainfuck_in_channel(channel: discord.Channel, code, program_input):
+# Stop the workers of the previous sandbox when the plugin is reloaded
+if "sandbox" in globals():
+    sandbox.shutdown()
+
+sandbox = Sandbox(client.loop, workers=brainfuck_workers, cpu_time=cpu_time, wall_time=wall_time,
+                  max_output=max_message_length)
+
+
+def compile_snippet(name: str):
+    """ Return the compiled program of a snippet, compiling it only when the code changed. """
+    code = cfg.data[name]["code"]
+    if name not in compiled_snippets or not compiled_snippets[name][0] == code:
+        compiled_snippets[name] = (code, compile_brainfuck(code))
+
+    return compiled_snippets[name][1]
+
+
+async def brainfuck_in_channel(channel: discord.Channel, code, program_input, program: list=None):
+    """ Run brainfuck code in the sandbox and send the output, along with any error.
+
+    :param program: the already compiled code, or None. """
     try:
-        output = run_brainfuck(code, program_input)
-    except Exception as e:
-        await client.send_message(channel, "```\n{}: {}```".format(type(e).__name__, str(e)))
-    else:
-        assert len(output) <= 2000, "**The output was too long.**"
-        await client.send_message(channel, "```\n{}```".format(output))
+        if program is None:
+            program = compile_brainfuck(code)
+    except SyntaxError as e:
+        await client.send_message(channel, "```\nSyntaxError: {}```".format(e))
+        return
+
+    output, error = await sandbox.run(program, program_input)
+    if error is not None:
+        # Cut the output so that the error always fits in the message
+        output = output[:max_message_length - len(error) - 16]
+        output = "{}\n{}".format(output, error) if output else error
 
+    assert len(output) <= max_message_length - 8, "**The output was too long.**"
+    await client.send_message(channel, "```\n{}```".format(output))
 
-@plugins.command(aliases="bf")
+
+@plugins.command(aliases="bf", cost=2)
 async def brainfuck(message: discord.Message, code: Annotate.Code):
     """ Run the given brainfuck code and prompt for input if required.
 
@@ -194,7 +101,12 @@ async def run(message: discord.Message, name: snippet_name, args: Annotate.Clean
     assert_exists(name)
 
     code = cfg.data[name]["code"]
-    await brainfuck_in_channel(message.channel, code, args)
+    try:
+        program = compile_snippet(name)
+    except SyntaxError:
+        program = None  # Let brainfuck_in_channel report the error
+
+    await brainfuck_in_channel(message.channel, code, args, program)
 
 
 @brainfuck.command(aliases="create set")
@@ -227,6 +139,7 @@ async def remove(message: discord.Message, name: snippet_name):
     assert_author(name, message.author)
 
     del cfg.data[name]
+    compiled_snippets.pop(name, None)
     cfg.save()
     await client.say(message, "Removed entry with name `{}`.".format(name))
 
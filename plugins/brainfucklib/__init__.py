@@ -0,0 +1 @@
+""" Library for the brainfuck plugin. """
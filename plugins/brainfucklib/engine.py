@@ -0,0 +1,229 @@
+""" Compiler and interpreter of brainfuck code.
+
+    Code is compiled once into a list of (opcode, argument) tuples, where
+    runs of +- and <> are folded into a single instruction, brackets know
+    their jump targets, and the common loop idioms [-], [>] and move loops
+    such as [->+<] are replaced by a single instruction. Compiled programs
+    are plain data, so they can be stored and sent to worker processes. """
+
+import time
+
+cells = 2 ** 15  # The size of the tape, which wraps around at both ends
+max_iterations = 2 ** 17
+check_interval = 2 ** 12  # The number of iterations between checking the time budgets
+
+brainfuck_chars = "+-><][.,"
+
+# Opcodes
+ADD, MOVE, OUTPUT, INPUT, OPEN, CLOSE, CLEAR, MULTIPLY, SCAN = range(9)
+
+
+class TooManyIterations(Exception):
+    pass
+
+
+class InfiniteLoop(Exception):
+    pass
+
+
+class TimeLimitExceeded(Exception):
+    pass
+
+
+class OutputTooLong(Exception):
+    pass
+
+
+def _fold_loop(body: list):
+    """ Return a single instruction replacing a loop with the given body, or None. """
+    if len(body) == 1:
+        op, arg = body[0]
+        if op == ADD and arg in (1, 255):
+            return CLEAR, 0
+        if op == MOVE:
+            return SCAN, arg
+
+    if not all(op in (ADD, MOVE) for op, _ in body):
+        return None
+
+    # A loop that only adds and moves, ends on the same cell and subtracts 1 from it
+    # adds the cell's value times the additions to every other cell, e.g [->++>+<<]
+    offset, additions = 0, {}
+    for op, arg in body:
+        if op == ADD:
+            additions[offset] = (additions.get(offset, 0) + arg) % 256
+        else:
+            offset += arg
+
+    if offset != 0 or additions.get(0) != 255:
+        return None
+
+    return MULTIPLY, tuple((offset, n) for offset, n in sorted(additions.items()) if offset != 0 and n)
+
+
+def compile_brainfuck(code: str):
+    """ Compile brainfuck code. Every character that is not an instruction is ignored.
+
+    :raises: SyntaxError when the brackets don't match.
+    :returns: list of (opcode, argument). """
+    program, loops = [], []
+
+    for i, char in enumerate(code):
+        if char in "+-":
+            n = 1 if char == "+" else 255
+            if program and program[-1][0] == ADD:
+                n = (program.pop()[1] + n) % 256
+            if n:
+                program.append((ADD, n))
+        elif char in "><":
+            n = 1 if char == ">" else -1
+            if program and program[-1][0] == MOVE:
+                n += program.pop()[1]
+            if n:
+                program.append((MOVE, n))
+        elif char == ".":
+            program.append((OUTPUT, 0))
+        elif char == ",":
+            program.append((INPUT, 0))
+        elif char == "[":
+            loops.append((i, len(program)))
+            program.append((OPEN, None))
+        elif char == "]":
+            if not loops:
+                raise SyntaxError("{}: Loop was never started!".format(i))
+
+            start = loops.pop()[1]
+            folded = _fold_loop(program[start + 1:])
+            if folded is not None:
+                del program[start:]
+                program.append(folded)
+            else:
+                program[start] = (OPEN, len(program))
+                program.append((CLOSE, start))
+
+    if loops:
+        raise SyntaxError("{}: Loop never ends!".format(loops[-1][0]))
+
+    return program
+
+
+def execute(program: list, for_input: str="", max_iterations: int=max_iterations, cpu_time: float=None,
+            wall_time: float=None, max_output: int=None, output: bytearray=None):
+    """ Execute a compiled program. The , instruction reads a byte of the input,
+    and reads 0 when there is no input left. See encode_input().
+
+    A loop raises InfiniteLoop when the pointer and its value are unchanged after an
+    iteration, unless input was read. Every instruction counts as one iteration.
+
+    :param max_iterations: the maximum number of iterations, or None.
+    :param cpu_time: the maximum CPU time in seconds, or None.
+    :param wall_time: the maximum time in seconds, or None.
+    :param max_output: the maximum number of bytes output, or None.
+    :param output: a bytearray to write the output to, which keeps the output so far when an exception is raised.
+    :raises: InfiniteLoop, TooManyIterations, TimeLimitExceeded or OutputTooLong.
+    :returns: the output, or the final pointer value when there is no output. """
+    tape = bytearray(cells)
+    input_bytes = encode_input(for_input)
+    if output is None:
+        output = bytearray()
+    loop_states = {}  # Index of a CLOSE instruction -> (cursor, value) after the previous iteration
+
+    cpu_deadline = time.process_time() + cpu_time if cpu_time is not None else None
+    wall_deadline = time.monotonic() + wall_time if wall_time is not None else None
+    check_at = check_interval if max_iterations is None else min(check_interval, max_iterations)
+
+    cursor, input_cursor, pc, iterations = 0, 0, 0, 0
+    length = len(program)
+    while pc < length:
+        op, arg = program[pc]
+
+        if op == ADD:
+            tape[cursor] = (tape[cursor] + arg) & 255
+        elif op == MOVE:
+            cursor = (cursor + arg) % cells
+        elif op == CLOSE:
+            if tape[cursor]:
+                state = (cursor, tape[cursor])
+                if loop_states.get(pc) == state:
+                    raise InfiniteLoop("{}: Pointer value unchanged.".format(arg))
+
+                loop_states[pc] = state
+                pc = arg
+            else:
+                loop_states.pop(pc, None)
+        elif op == OPEN:
+            if not tape[cursor]:
+                pc = arg
+        elif op == CLEAR:
+            tape[cursor] = 0
+        elif op == MULTIPLY:
+            value = tape[cursor]
+            if value:
+                for offset, n in arg:
+                    i = (cursor + offset) % cells
+                    tape[i] = (tape[i] + value * n) & 255
+                tape[cursor] = 0
+        elif op == SCAN:
+            if arg == 1:
+                i = tape.find(0, cursor)
+                cursor = i if i >= 0 else tape.find(0)
+            elif arg == -1:
+                i = tape.rfind(0, 0, cursor + 1)
+                cursor = i if i >= 0 else tape.rfind(0)
+            else:
+                for _ in range(cells):
+                    if not tape[cursor]:
+                        break
+                    cursor = (cursor + arg) % cells
+
+            if cursor < 0 or tape[cursor]:
+                raise InfiniteLoop("{}: No empty cell to move to.".format(pc))
+        elif op == OUTPUT:
+            output.append(tape[cursor])
+            if max_output is not None and len(output) > max_output:
+                raise OutputTooLong("Program output more than {} characters".format(max_output))
+        elif op == INPUT:
+            tape[cursor] = input_bytes[input_cursor] if input_cursor < len(input_bytes) else 0
+            input_cursor += 1
+            loop_states.clear()
+
+        pc += 1
+        iterations += 1
+        if iterations >= check_at:
+            if max_iterations is not None and iterations >= max_iterations:
+                raise TooManyIterations("Program exceeded maximum number of iterations ({})".format(max_iterations))
+            if cpu_deadline is not None and time.process_time() > cpu_deadline:
+                raise TimeLimitExceeded("Program exceeded the CPU time limit ({}s)".format(cpu_time))
+            if wall_deadline is not None and time.monotonic() > wall_deadline:
+                raise TimeLimitExceeded("Program exceeded the time limit ({}s)".format(wall_time))
+
+            check_at = iterations + check_interval
+            if max_iterations is not None:
+                check_at = min(check_at, max_iterations)
+
+    if not output:
+        return "Pointer value: {}".format(tape[cursor])
+
+    return decode_output(output)
+
+
+def encode_input(for_input: str):
+    """ Encode program input with one byte per character when possible, so that
+    characters like é fit in a single cell, and as UTF-8 otherwise. """
+    try:
+        return for_input.encode("latin-1")
+    except UnicodeEncodeError:
+        return for_input.encode("utf-8")
+
+
+def decode_output(output: bytes):
+    """ Decode program output as UTF-8, or as one character per byte when it isn't. """
+    try:
+        return output.decode("utf-8")
+    except UnicodeDecodeError:
+        return output.decode("latin-1")
+
+
+def run_brainfuck(code: str, for_input: str="", max_iterations: int=max_iterations):
+    """ Compile and execute brainfuck code. See execute(). """
+    return execute(compile_brainfuck(code), for_input, max_iterations)
@@ -0,0 +1,73 @@
+""" Worker processes for running brainfuck programs off the event loop.
+
+    Every run has a CPU and a wall-clock budget, which the interpreter checks
+    itself, so a worker is always freed once a program runs out of time. The
+    output is capped as well, and the output so far is returned along with
+    any error. """
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from . import engine
+
+grace_time = 2  # Seconds to wait past the wall-clock budget before giving up on a worker
+
+
+def run_program(program: list, for_input: str, cpu_time: float, wall_time: float, max_output: int):
+    """ Execute a compiled program in a worker.
+
+    :returns: tuple of (output, error), where error is a string or None. """
+    output = bytearray()
+    try:
+        result = engine.execute(program, for_input, max_iterations=None, cpu_time=cpu_time, wall_time=wall_time,
+                                max_output=max_output, output=output)
+    except Exception as e:
+        return engine.decode_output(output[:max_output]), "{}: {}".format(type(e).__name__, e)
+    else:
+        return result, None
+
+
+class Sandbox:
+    """ Bounded process pool running brainfuck programs with time budgets. """
+    def __init__(self, loop: asyncio.AbstractEventLoop, workers: int=2, cpu_time: float=2.0, wall_time: float=5.0,
+                 max_output: int=2000):
+        """
+        :param workers: the number of worker processes, which is also the number of programs running at once.
+        :param cpu_time: the CPU time in seconds a program may use.
+        :param wall_time: the time in seconds a program may run, not counting the time waiting for a worker.
+        :param max_output: the maximum number of bytes a program may output. """
+        self.loop = loop
+        self.workers = workers
+        self.cpu_time = cpu_time
+        self.wall_time = wall_time
+        self.max_output = max_output
+        self.executor = None  # Created when the first program is run
+        self.semaphore = asyncio.Semaphore(workers)
+
+    async def run(self, program: list, for_input: str=""):
+        """ Run a compiled program in a worker process.
+
+        :returns: tuple of (output, error), see run_program(). """
+        async with self.semaphore:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+            try:
+                future = self.loop.run_in_executor(self.executor, run_program, program, for_input,
+                                                   self.cpu_time, self.wall_time, self.max_output)
+                return await asyncio.wait_for(future, self.wall_time + grace_time)
+            except asyncio.TimeoutError:
+                # The worker should have stopped itself by now, so leave it behind and start a fresh pool
+                self.shutdown()
+                return "", "TimeLimitExceeded: Program exceeded the time limit ({}s)".format(self.wall_time)
+            except BrokenProcessPool:
+                # A worker died, e.g killed for using too much memory, so the next program needs a fresh pool
+                self.shutdown()
+                return "", "BrokenProcessPool: The program was stopped unexpectedly"
+
+    def shutdown(self):
+        """ Stop the worker processes once the running programs are done. """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
@@ -9,14 +9,14 @@ Commands:
 
 import os
 import re
-from io import BytesIO
 
 import discord
 import cairosvg
 from PIL import Image
 
 import plugins
-from pcbot import Annotate, utils
+from pcbot import Annotate, Config, utils, assets
+from plugins.imagelib.cache import image_cache
 
 
 client = plugins.client  # type: discord.Client
@@ -25,23 +25,41 @@ emoji_path = "plugins/twemoji21lib/"
 default_size = 1024
 max_width = 2048
 max_emoji = 64
-emoji = {}
+emoji = assets.AssetStore(emoji_path)  # The SVG bytes of every emoji, read when first rendered
+emoji_trie = {}  # Nested dicts of characters, where the None key holds the name of the emoji ending there
+
+# Rendered emoji are kept in the shared image cache. Emoji can also be rendered to disk
+# in the common sizes with the emojirender command, so that they never have to be rendered again
+render_path = Config.config_path + "emoji_png/"
+render_sizes = (1024, 512, 256, 112)
+render_stats = dict(memory=0, disk=0, rendered=0)  # Where every requested emoji was found
 
 emote_regex = re.compile(r"<:(?P<name>\w+):(?P<id>\d+)>")
-emote_cache = {}  # Cache for all custom emotes/emoji
 emote_size = 112
 
 
 def init_emoji():
-    """ This will be a list of all emoji SVG files. Storing this in RAM is for
-    easier access, considering the library of emojies only take up about 2.5MB
-    (or 4MB in disk) as of now. If the library expands, the size should not
-    increase drastically. """
-    for file in os.listdir(emoji_path):
-        with open(os.path.join(emoji_path, file), "rb") as f:
-            emoji_name = file.split(".")[0]  # Strip the extension
-            emoji_bytes = f.read()
-            emoji[emoji_name] = emoji_bytes
+    """ Build the trie of every emoji's characters, used for parsing emoji.
+    The emoji themselves are only read from disk when they're rendered. """
+    for emoji_name in emoji:
+        node = emoji_trie
+        for codepoint in emoji_name.split("-"):
+            node = node.setdefault(chr(int(codepoint, 16)), {})
+        node[None] = emoji_name
+
+
+def render_emoji(char: str, size: int):
+    """ Render an emoji with the given size and return the PNG bytes. """
+    emoji_bytes = emoji[char]
+    size_bytes = bytes(str(size), encoding="utf-8")
+    emoji_bytes = emoji_bytes.replace(b"<svg ",
+                                      b"<svg width=\"" + size_bytes + b"px\" height=\"" + size_bytes + b"px\" ")
+    return cairosvg.svg2png(emoji_bytes)
+
+
+def rendered_path(char: str, size: int):
+    """ Return the path of an emoji rendered to disk. """
+    return os.path.join(render_path, str(size), char + ".png")
 
 
 def get_emoji(char: str, size=default_size):
@@ -50,87 +68,108 @@ def get_emoji(char: str, size=default_size):
     if char not in emoji:
         return None
 
-    emoji_bytes = emoji[char]
-    size_bytes = bytes(str(size), encoding="utf-8")
-    emoji_bytes = emoji_bytes.replace(b"<svg ",
-                                      b"<svg width=\"" + size_bytes + b"px\" height=\"" + size_bytes + b"px\" ")
-    return Image.open(BytesIO(cairosvg.svg2png(emoji_bytes)))
+    size = int(size)
+    key = "emoji:{}:{}".format(char, size)
+    image_object = image_cache.get_image(key)
+    if image_object is not None:
+        render_stats["memory"] += 1
+        return image_object
+
+    # Use the emoji rendered to disk when there is one, otherwise render it
+    path = rendered_path(char, size)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            image_bytes = f.read()
+        render_stats["disk"] += 1
+    else:
+        image_bytes = render_emoji(char, size)
+        render_stats["rendered"] += 1
 
+    image_cache.put(key, image_bytes)
+    return image_cache.get_image(key, count=False)
 
-async def get_emote(emote_id: str, server: discord.Server):
-    """ Return the image of a custom emote. """
-    emote = discord.Emoji(id=emote_id, server=server)
 
-    # Return the cached version if possible
-    if emote.id in emote_cache:
-        return Image.open(emote_cache[emote.id])
+def render_to_disk(sizes: tuple):
+    """ Render every emoji with the given sizes to disk, skipping those already rendered.
 
-    # Otherwise, download the emote, store it in the cache and return
-    emote_bytes = await utils.download_file(emote.url, bytesio=True)
-    emote_cache[emote.id] = emote_bytes
-    return Image.open(emote_bytes)
+    :returns: the number of emoji rendered. """
+    rendered = 0
+    for size in sizes:
+        os.makedirs(os.path.join(render_path, str(size)), exist_ok=True)
 
+        for char in emoji:
+            path = rendered_path(char, size)
+            if os.path.exists(path):
+                continue
 
-def parse_emoji(chars: list):
-    """ Go through and return all emoji in the given list of characters
-    (or Image objects). """
-    # Convert all characters in the given list to hex format strings, and leave the Image objects alone
-    chars = [hex(ord(c))[2:] if type(c) is str else c for c in chars]
-    chars_remaining = length = len(chars)
+            # Write to a temporary file first, so that the emoji is never read while being written
+            with open(path + ".tmp", "wb") as f:
+                f.write(render_emoji(char, size))
+            os.replace(path + ".tmp", path)
+            rendered += 1
 
-    # Try the entire string backwards, and reduce the length by one character until there's a match
-    while True:
-        sliced_emoji = chars[:length]
-        if not sliced_emoji:
-            break
+    return rendered
 
-        # If this is a custom emote, yield it and progress
-        if isinstance(sliced_emoji[0], Image.Image):
-            yield sliced_emoji[0]
 
-            chars = chars[1:]
-            chars_remaining = length = len(chars)
-            continue
+async def get_emote_bytes(emote_id: str, server: discord.Server):
+    """ Return the downloaded bytes of a custom emote. Emotes are kept in the
+    shared image cache. """
+    emote = discord.Emoji(id=emote_id, server=server)
+    key = "emote:" + emote.id
 
-        # If the emoji is in the list, update the index and reset the length, with the updated index
-        emoji_str = "-".join(e for e in sliced_emoji if not isinstance(e, Image.Image))
-        if emoji_str in emoji.keys():
-            yield emoji_str
+    # Return the cached version if possible
+    emote_bytes = image_cache.get_bytes(key)
+    if emote_bytes is not None:
+        return emote_bytes
 
-            chars = chars[length:]
-            chars_remaining = length = len(chars)
-            continue
+    # Otherwise, download the emote and store it in the cache
+    emote_bytes = await utils.download_file(emote.url)
+    image_cache.put(key, emote_bytes)
+    return emote_bytes
 
-        # When we don't find an emoji, reduce the length
-        length -= 1
 
-        # When the length is 0, but the amount of characters is greater than 1, remove the first one
-        if length == 0 and chars_remaining > 1:
-            chars = chars[1:]
-            chars_remaining = length = len(chars)
+async def get_emote(emote_id: str, server: discord.Server):
+    """ Return the image of a custom emote. """
+    await get_emote_bytes(emote_id, server)
+    return image_cache.get_image("emote:" + emote_id, count=False)
+
+
+def parse_emoji(text: str):
+    """ Go through and yield the name of every emoji in the text, using the
+    longest emoji starting at every position. """
+    i, length = 0, len(text)
+    while i < length:
+        # Follow the trie as far as the text goes, and remember the last emoji we passed
+        node, name, end = emoji_trie, None, i
+        for j in range(i, length):
+            node = node.get(text[j])
+            if node is None:
+                break
+
+            if None in node:
+                name, end = node[None], j + 1
+
+        if name is None:
+            i += 1
+        else:
+            yield name
+            i = end
 
 
 async def format_emoji(text: str, server: discord.Server):
     """ Creates a list supporting both emoji and custom emotes. """
-    char_and_emotes = []
-
-    # Loop through each character and compare with custom emotes.
-    # Add characters to list, along with emote byte-strings
-    text_iter = iter(enumerate(text))
+    parsed_emoji = []
     has_custom = False
-    for i, c in text_iter:
-        match = emote_regex.match(text[i:])
-        if match:
-            char_and_emotes.append(await get_emote(match.group("id"), server))
-            has_custom = True
-
-            # Skip ahead in the iterator
-            for _ in range(len(match.group(0)) - 1):
-                next(text_iter)
-        else:
-            char_and_emotes.append(c)
 
-    parsed_emoji = list(parse_emoji(char_and_emotes))
+    # Parse the emoji between every custom emote, and add the emote images in between
+    start = 0
+    for match in emote_regex.finditer(text):
+        parsed_emoji.extend(parse_emoji(text[start:match.start()]))
+        parsed_emoji.append(await get_emote(match.group("id"), server))
+        has_custom = True
+        start = match.end()
+
+    parsed_emoji.extend(parse_emoji(text[start:]))
 
     # When the size of all emoji next to each other is greater than the max width,
     # divide the size to properly fit the max_width at all times
@@ -146,7 +185,7 @@ async def format_emoji(text: str, server: discord.Server):
     return [e if isinstance(e, Image.Image) else get_emoji(e, size=size) for e in parsed_emoji], has_custom
 
 
-@plugins.command(aliases="huge")
+@plugins.command(aliases="huge", cost=2)
 async def greater(message: discord.Message, text: Annotate.CleanContent):
     """ Gives a **huge** version of emojies. """
     # Parse all unicode and load the emojies
@@ -190,4 +229,26 @@ async def greater(message: discord.Message, text: Annotate.CleanContent):
     await client.send_file(message.channel, image_fp, filename="emojies.png")
 
 
+@plugins.command(hidden=True)
+@utils.owner
+async def emojirender(message: discord.Message, *sizes: utils.int_range(f=1, t=max_width)):
+    """ Render every emoji to disk in the given sizes, or the common sizes. Rendered
+    emoji are loaded from disk instead of being rendered again. """
+    sizes = sizes or render_sizes
+    await client.say(message, "Rendering emoji in sizes {}. This may take a while.".format(
+        ", ".join(str(size) for size in sizes)))
+
+    rendered = await client.loop.run_in_executor(None, render_to_disk, sizes)
+    await client.say(message, "**Rendered {} emoji.**".format(rendered))
+
+
+@plugins.command(hidden=True)
+@utils.owner
+async def emojistats(message: discord.Message):
+    """ Display where requested emoji were found. """
+    total = sum(render_stats.values())
+    await client.say(message, utils.format_code("\n".join(
+        "{}: {} ({:.0%})".format(name, count, count / total if total else 0) for name, count in render_stats.items())))
+
+
 init_emoji()
\ No newline at end of file
@@ -2,48 +2,73 @@
 
 Commands:
     resize """
+import math
 import re
 from io import BytesIO
 
-from PIL import Image, ImageSequence, ImageOps
+import aiohttp
+from PIL import Image
 import discord
 
 import plugins
-from pcbot import utils
+from pcbot import utils, Annotate
+from plugins.imagelib import ops, pool
+from plugins.imagelib.cache import image_cache
 
-url_only, gif_support = False, True
+url_only = False
 
 # See if we can convert emoji using the emoji.py plugin
 try:
-    from .emoji import get_emote, get_emoji, emote_regex
+    from .emoji import get_emote_bytes, get_emoji, emote_regex
 except:
     url_only = True
 
-# See if we can create gifs using imageio
-try:
-    import imageio
-except:
-    gif_support = False
-
 
 client = plugins.client  # type: discord.Client
 
-extension_regex = re.compile(r"image/(?P<ext>\w+)(?:\s|$)")
 mention_regex = re.compile(r"<@!?(?P<id>\d+)>")
 max_bytes = 4096 ** 2  # 4 MB
 max_gif_bytes = 1024 * 128  # 128kB
+chunk_size = 1024 * 64
+
+# The first bytes of every supported image format
+image_signatures = {
+    b"\x89PNG\r\n\x1a\n": "png",
+    b"\xff\xd8\xff": "jpeg",
+    b"GIF87a": "gif",
+    b"GIF89a": "gif",
+    b"BM": "bmp",
+    b"II*\x00": "tiff",
+    b"MM\x00*": "tiff"
+}
+signature_bytes = 12  # Enough bytes to tell any of the formats apart, including webp
+
+# Images are decoded, modified and encoded in worker processes, with every user taking turns
+image_workers = 2
+max_queued_images = 3  # The number of images a user can have processed at once
+max_pipeline_steps = 8
+pipeline_flags = ("-nearest",)
+
+# Stop the workers of the previous pool when the plugin is reloaded
+if "image_pool" in globals():
+    image_pool.shutdown()
+
+image_pool = pool.ImagePool(client.loop, workers=image_workers, max_queued=max_queued_images)
 
 
 class ImageArg:
-    def __init__(self, image_object: Image.Image, format: str):
-        self.object = image_object
+    def __init__(self, data: bytes, format: str):
+        self.data = data
+        self.object = Image.open(BytesIO(data))  # Only the header is read, for the size and info of the image
         self.format = format
         self.extension = format.lower()
+        self.operations = []  # The operations to apply when the image is processed, see imagelib.ops
+        self.params = {}  # Any additional parameters sent to the writer
+        self.size = self.object.size  # The size of the image after every operation
         self.clean_format()
 
         # Figure out if this is a gif by looking for the duration argument. Might only work for gifs
         self.gif = bool(self.object.info.get("duration"))
-        self.gif_bytes = None   # For easier upload of gifs, store the bytes in memory
 
     def clean_format(self, real_convert=True):
         """ Return working options of JPG images. """
@@ -60,32 +85,87 @@ class ImageArg:
         self.extension = self.format = ext
         self.clean_format(real_convert=real_jpg)
 
-    def modify(self, function, *args, **kwargs):
-        """ Modify the image object using the given Image function.
-        This function supplies sequence support. """
-        if not gif_support or not self.gif:
-            self.object = function(self.object, *args, **kwargs)
-        else:
-            frames = []
-            duration = self.object.info.get("duration") / 1000
-            for frame in ImageSequence.Iterator(self.object):
-                frame_bytes = utils.convert_image_object(function(frame, *args, **kwargs))
-                frames.append(imageio.imread(frame_bytes, format="PNG"))
-
-            # Save the image as bytes and recreate the image object
-            image_bytes = imageio.mimwrite(imageio.RETURN_BYTES, frames, format=self.format, duration=duration)
-            self.object = Image.open(BytesIO(image_bytes))
-            self.gif_bytes = image_bytes
+    def modify(self, operation: str, *args, **kwargs):
+        """ Modify the image using the given operation in imagelib.ops when
+        the image is processed. Gifs have the operation applied to every frame. """
+        self.operations.append((operation, args, kwargs))
 
     def to_rgb(self):
-        """ Convert to RGB using solution from http://stackoverflow.com/questions/9166400/ """
-        if not self.object.mode == "RGBA":
-            return
+        """ Convert to RGB when the image is processed. """
+        self.modify("to_rgb")
+
+    async def process(self, user_id: str, **params):
+        """ Apply every operation and encode the image in a worker process.
+
+        :param user_id: the user whose turn this is in the image pool.
+        :param params: any additional parameters sent to the writer.
+        :raises: pool.QueueFull when the user has too many images being processed.
+        :returns: the encoded image as bytes. """
+        # Metrics are recorded by operation, so a combination of operations is recorded as a pipeline
+        names = set(name for name, _, _ in self.operations if not name == "to_rgb")
+        name = names.pop() if len(names) == 1 else "pipeline" if names else "convert"
+        return await image_pool.run(user_id, name, ops.process, self.data, self.operations, self.format,
+                                    gif=self.gif, **params)
+
+
+def sniff_format(data: bytes):
+    """ Return the format of an image from its first bytes, or None if it's not a supported image. """
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+
+    for signature, image_format in image_signatures.items():
+        if data.startswith(signature):
+            return image_format
+
+    return None
+
+
+async def download_image(url: str):
+    """ Download an image. The format is found from the first bytes, and the
+    download is aborted as soon as the image exceeds the maximum size of its format.
+
+    :raises: ValueError when the URL is invalid.
+    :returns: tuple of (the image as bytes, the image format). """
+    data, image_format, max_size = bytearray(), None, max_bytes
+
+    async with aiohttp.ClientSession(loop=client.loop) as session:
+        async with session.get(url) as response:
+            while True:
+                chunk = await response.content.read(chunk_size)
+                data += chunk
+
+                # Make sure the file is an image once we have enough bytes, or the whole file
+                if image_format is None and (len(data) >= signature_bytes or not chunk):
+                    image_format = sniff_format(data)
+                    assert image_format, "**The given URL is not an image.**"
+
+                    # Refuse right away when the server tells us the image is too big
+                    max_size = max_gif_bytes if image_format == "gif" else max_bytes
+                    length = response.headers.get("CONTENT-LENGTH")
+                    assert not (length and length.isdigit() and int(length) > max_size), \
+                        "**This image exceeds the maximum size of `{}kB` for this format.**".format(max_size // 1024)
+
+                assert len(data) <= max_size, \
+                    "**This image exceeds the maximum size of `{}kB` for this format.**".format(max_size // 1024)
+
+                if not chunk:
+                    break
 
-        self.object.load()
-        background = Image.new("RGB", self.object.size, (0, 0, 0))
-        background.paste(self.object, mask=self.object.split()[3])
-        self.object = background
+    return bytes(data), image_format
+
+
+async def get_image_bytes(url: str):
+    """ Return an image from the shared image cache, or download and cache it.
+
+    :raises: ValueError when the URL is invalid.
+    :returns: tuple of (the image as bytes, the image format). """
+    image_bytes = image_cache.get_bytes(url) if url.startswith(("http://", "https://")) else None
+    if image_bytes is not None:
+        return image_bytes, sniff_format(image_bytes)
+
+    image_bytes, image_format = await download_image(url)
+    image_cache.put(url, image_bytes)
+    return image_bytes, image_format
 
 
 @plugins.argument("{open}url/@user" + ("" if url_only else "/emoji") + "{suffix}{close}", pass_message=True)
@@ -95,18 +175,15 @@ async def image(message: discord.Message, url_or_emoji: str):
     if "http://" in url_or_emoji or "https://" in url_or_emoji:
         url_or_emoji = url_or_emoji.strip("<>")
 
-    try:  # Check if the given string is a url and save the headers for later
-        headers = await utils.retrieve_headers(url_or_emoji)
+    try:  # Check if the given string is a url and download the image
+        image_bytes, image_format = await get_image_bytes(url_or_emoji)
     except ValueError:  # Not a valid url, let's see if it's a mention
         match = mention_regex.match(url_or_emoji)
         if match:
             member = message.server.get_member(match.group("id"))
-            avatar_headers = await utils.retrieve_headers(member.avatar_url)
-            assert not avatar_headers["CONTENT-TYPE"].endswith("gif"), "**GIF avatars are currently unsupported.**"
-
-            image_bytes = await utils.download_file(member.avatar_url.replace(".webp", ".png"), bytesio=True)
-            image_object = Image.open(image_bytes)
-            return ImageArg(image_object, format="PNG")
+            image_bytes, image_format = await get_image_bytes(member.avatar_url.replace(".webp", ".png"))
+            assert not image_format == "gif", "**GIF avatars are currently unsupported.**"
+            return ImageArg(image_bytes, format=image_format)
 
         # Nope, not a mention. If we support emoji, we can progress further
         assert not url_only, "`{}` **is not a valid URL or user mention.**".format(url_or_emoji)
@@ -115,37 +192,19 @@ async def image(message: discord.Message, url_or_emoji: str):
         char = "-".join(hex(ord(c))[2:] for c in url_or_emoji)  # Convert to a hex string
         image_object = get_emoji(char, size=256)
         if image_object:
-            return ImageArg(image_object, format="PNG")
+            return ImageArg(utils.convert_image_object(image_object).getvalue(), format="PNG")
 
         # Not an emoji, perhaps it's an emote
         match = emote_regex.match(url_or_emoji)
         if match:
-            image_object = await get_emote(match.group("id"), message.server)
-            if image_object:
-                return ImageArg(image_object, format="PNG")
+            image_bytes = await get_emote_bytes(match.group("id"), message.server)
+            if image_bytes:
+                return ImageArg(image_bytes, format="PNG")
 
         # Alright, we're out of ideas
         raise AssertionError("`{}` **is neither a URL, a mention nor an emoji.**".format(url_or_emoji))
 
-    # The URL was valid so let's make sure it's an image
-    match = extension_regex.search(headers["CONTENT-TYPE"])
-    assert match, "**The given URL is not an image.**"
-    image_format = match.group("ext")
-
-    # Make sure the image is not too big
-    gif = image_format.lower() == "gif"
-    if "CONTENT-LENGTH" in headers:
-        size = headers["CONTENT-LENGTH"]
-        max_size = max_gif_bytes if gif else max_bytes
-        assert int(size) <= max_size, \
-            "**This image exceeds the maximum size of `{}kB` for this format.**".format(max_size // 1024)
-    elif gif:  # If there is no information on the size of the file, we'll refuse if the image is a gif
-        raise AssertionError("**The size of this GIF is unknown and was therefore rejected.**")
-
-    # Download the image and create the object
-    image_bytes = await utils.download_file(url_or_emoji, bytesio=True)
-    image_object = Image.open(image_bytes)
-    return ImageArg(image_object, format=image_format)
+    return ImageArg(image_bytes, format=image_format)
 
 
 @plugins.argument("({open}width{close}x{open}height{close} or *{open}scale{close})")
@@ -190,20 +249,66 @@ def clean_format(image_format: str, extension: str):
 
 
 async def send_image(message: discord.Message, image_arg: ImageArg, **params):
-    """ Send an image. """
+    """ Process and send an image. """
     try:
-        if image_arg.gif and gif_support:
-            image_fp = BytesIO(image_arg.gif_bytes)
-        else:
-            image_fp = utils.convert_image_object(image_arg.object, image_arg.format, **params)
+        image_bytes = await image_arg.process(message.author.id, **dict(image_arg.params, **params))
+    except pool.QueueFull:
+        raise AssertionError("**Please wait for your other images to finish, {}.**".format(message.author.name))
     except KeyError as e:
         await client.send_message(message.channel, "Image format `{}` is unsupported.".format(e))
     else:
-        await client.send_file(message.channel, image_fp,
+        await client.send_file(message.channel, BytesIO(image_bytes),
                                filename="{}.{}".format(message.author.display_name, image_arg.extension))
 
 
-@plugins.command(pos_check=lambda s: s.startswith("-"))
+def resize_image(image_arg: ImageArg, resolution: tuple, nearest: bool=False):
+    """ Resize an image with a resolution returned by parse_resolution. """
+    # Generate a new image based on the scale
+    if resolution[1] == 0:
+        w, h = image_arg.size
+        scale = resolution[0]
+        assert w * scale < 3000 and h * scale < 3000, "**The result image must be less than 3000 pixels in each axis.**"
+        resolution = (int(w * scale), int(h * scale))
+
+    image_arg.modify("resize", resolution, Image.NEAREST if nearest else Image.ANTIALIAS)
+    image_arg.size = resolution
+
+
+def rotate_image(image_arg: ImageArg, degrees: int, nearest: bool=False):
+    """ Rotate an image clockwise, expanding it to fit the rotated image. """
+    image_arg.modify("rotate", -degrees, Image.NEAREST if nearest else Image.BICUBIC, expand=True)
+
+    # The expanded image is the bounding box of the rotated image
+    w, h = image_arg.size
+    sin, cos = abs(math.sin(math.radians(degrees))), abs(math.cos(math.radians(degrees)))
+    image_arg.size = (round(w * cos + h * sin), round(w * sin + h * cos))
+
+
+def jpeg_image(image_arg: ImageArg, effect: tuple, quality: int):
+    """ Save an image as a low quality jpeg with the given effects. """
+    assert not image_arg.gif, "**JPEG saving only works on images.**"
+    image_arg.set_extension("jpg", real_jpg=False if "meme" in effect else True)
+
+    if "small" in effect:
+        w, h = image_arg.size
+        image_arg.modify("resize", (w // 3, h // 3))
+        image_arg.size = (w // 3, h // 3)
+
+    image_arg.params["quality"] = quality
+
+
+def invert_image(image_arg: ImageArg):
+    """ Invert the colors of an image. """
+    image_arg.set_extension("jpg")
+
+    # This function only works in images because of PIL limitations
+    assert not image_arg.gif, "**This command does not support GIF files.**"
+
+    image_arg.modify("invert")
+    image_arg.params["quality"] = 100
+
+
+@plugins.command(pos_check=lambda s: s.startswith("-"), cost=3)
 async def resize(message: discord.Message, image_arg: image, resolution: parse_resolution, *options,
                  extension: str.lower=None):
     """ Resize an image with the given resolution formatted as `<width>x<height>`
@@ -211,87 +316,152 @@ async def resize(message: discord.Message, image_arg: image, resolution: parse_r
     if extension:
         image_arg.set_extension(extension)
 
-    # Generate a new image based on the scale
-    if resolution[1] == 0:
-        w, h = image_arg.object.size
-        scale = resolution[0]
-        assert w * scale < 3000 and h * scale < 3000, "**The result image must be less than 3000 pixels in each axis.**"
-        resolution = (int(w * scale), int(h * scale))
-
     # Resize and upload the image
-    image_arg.modify(Image.Image.resize, resolution, Image.NEAREST if "-nearest" in options else Image.ANTIALIAS)
+    resize_image(image_arg, resolution, nearest="-nearest" in options)
     await send_image(message, image_arg)
 
 
-@plugins.command(pos_check=lambda s: s.startswith("-"), aliases="tilt")
+@plugins.command(pos_check=lambda s: s.startswith("-"), aliases="tilt", cost=3)
 async def rotate(message: discord.Message, image_arg: image, degrees: int, *options, extension: str.lower=None):
     """ Rotate an image clockwise using the given degrees. """
     if extension:
         image_arg.set_extension(extension)
 
     # Rotate and upload the image
-    image_arg.modify(Image.Image.rotate, -degrees, Image.NEAREST if "-nearest" in options else Image.BICUBIC,
-                     expand=True)
+    rotate_image(image_arg, degrees, nearest="-nearest" in options)
     await send_image(message, image_arg)
 
 
-@plugins.command()
+@plugins.command(cost=3)
 async def convert(message: discord.Message, image_arg: image, extension: str.lower):
     """ Convert an image to a specified extension. """
     image_arg.set_extension(extension)
     await send_image(message, image_arg)
 
 
-@plugins.command(aliases="jpg")
+@plugins.command(aliases="jpg", cost=3)
 async def jpeg(message: discord.Message, image_arg: image, *effect: utils.choice("small", "meme"),
                quality: utils.int_range(f=0, t=100)=5):
     """ Give an image some proper jpeg artifacting.
 
     Valid effects are: `small` """
-    assert not image_arg.gif, "**JPEG saving only works on images.**"
-    image_arg.set_extension("jpg", real_jpg=False if "meme" in effect else True)
-
-    if effect:
-        if "small" in effect:
-            w, h = image_arg.object.size
-            image_arg.modify(Image.Image.resize, (w // 3, h // 3))
-
-    await send_image(message, image_arg, quality=quality)
+    jpeg_image(image_arg, effect, quality)
+    await send_image(message, image_arg)
 
 
-@plugins.command()
+@plugins.command(cost=3)
 async def invert(message: discord.Message, image_arg: image):
     """ Invert the colors of an image. """
-    image_arg.set_extension("jpg")
-
-    # This function only works in images because of PIL limitations
-    assert not image_arg.gif, "**This command does not support GIF files.**"
-
-    # Invert the colors and upload the image
-    image_arg.modify(ImageOps.invert)
-    await send_image(message, image_arg, quality=100)
+    invert_image(image_arg)
+    await send_image(message, image_arg)
 
 
-@plugins.command()
+@plugins.command(cost=3)
 async def flip(message: discord.Message, image_arg: image, extension: str.lower=None):
     """ Flip an image in the y-axis. """
     if extension:
         image_arg.set_extension(extension)
 
     # Flip the image
-    image_arg.modify(Image.Image.transpose, Image.FLIP_TOP_BOTTOM)
+    image_arg.modify("transpose", Image.FLIP_TOP_BOTTOM)
     try:
         await send_image(message, image_arg)
     except IOError:
         await client.say(message, "**The image format is not supported (must be L or RGB)**")
 
 
-@plugins.command()
+@plugins.command(cost=3)
 async def mirror(message: discord.Message, image_arg: image, extension: str.lower=None):
     """ Mirror an image along the x-axis. """
     if extension:
         image_arg.set_extension(extension)
 
     # Mirror the image
-    image_arg.modify(Image.Image.transpose, Image.FLIP_LEFT_RIGHT)
+    image_arg.modify("transpose", Image.FLIP_LEFT_RIGHT)
     await send_image(message, image_arg)
+
+
+def apply_step(image_arg: ImageArg, step: str):
+    """ Apply one step of an image pipeline, formatted like the command of the
+    same name without the image. """
+    assert step.split(), "**Every step in the pipeline needs a command.**"
+    name, *args = step.split()
+    name = name.lower()
+    # Only known flags are options, since arguments such as degrees may be negative
+    options = [arg.lower() for arg in args if arg.lower() in pipeline_flags]
+    args = [arg.lower() for arg in args if arg.lower() not in pipeline_flags]
+
+    if name in ("resize", "rotate", "tilt"):
+        assert args, "**`{}` needs a {}.**".format(name, "resolution" if name == "resize" else "number of degrees")
+        if name == "resize":
+            resolution = parse_resolution(args[0])
+            assert resolution, "**`{}` is not a valid resolution.**".format(args[0])
+            resize_image(image_arg, resolution, nearest="-nearest" in options)
+        else:
+            try:
+                degrees = int(args[0])
+            except ValueError:
+                raise AssertionError("**Degrees must be an integer, not `{}`.**".format(args[0]))
+            rotate_image(image_arg, degrees, nearest="-nearest" in options)
+        extension = args[1] if len(args) > 1 else None
+    elif name in ("jpeg", "jpg"):
+        effect = tuple(arg for arg in args if arg in ("small", "meme"))
+        quality = [utils.int_range(f=0, t=100)(arg) for arg in args if arg not in effect]
+        assert None not in quality and len(quality) <= 1, "**Usage: `jpeg [small] [meme] [quality]`**"
+        jpeg_image(image_arg, effect, quality[0] if quality else 5)
+        extension = None
+    elif name == "invert":
+        invert_image(image_arg)
+        extension = None
+    elif name in ("flip", "mirror"):
+        image_arg.modify("transpose", Image.FLIP_TOP_BOTTOM if name == "flip" else Image.FLIP_LEFT_RIGHT)
+        extension = args[0] if args else None
+    elif name == "convert":
+        assert args, "**`convert` needs an extension.**"
+        extension = args[0]
+    else:
+        raise AssertionError("**`{}` can't be used in a pipeline. Use either of `resize`, `rotate`, `jpeg`, "
+                             "`invert`, `flip`, `mirror` or `convert`.**".format(name))
+
+    if extension:
+        image_arg.set_extension(extension)
+
+
+@plugins.command(aliases="pipeline", cost=3)
+async def img(message: discord.Message, image_arg: image, pipeline: Annotate.Content):
+    """ Apply several image commands in a row, separated by `|`. The image is
+    only downloaded and uploaded once, e.g `{pre}img <url> resize *0.5 | rotate 90 | jpeg 10`.
+
+    Valid commands are `resize`, `rotate`, `jpeg`, `invert`, `flip`, `mirror` and `convert`,
+    using the same arguments as usual except for the image. """
+    steps = pipeline.split("|")
+    assert len(steps) <= max_pipeline_steps, "**A pipeline can have at most {} steps.**".format(max_pipeline_steps)
+
+    for step in steps:
+        apply_step(image_arg, step)
+
+    try:
+        await send_image(message, image_arg)
+    except IOError:
+        await client.say(message, "**The image format is not supported (must be L or RGB)**")
+
+
+@plugins.command(hidden=True)
+@utils.owner
+async def imagestats(message: discord.Message):
+    """ Display the time spent queued and the CPU time used by every image operation. """
+    lines = []
+    for name, metric in sorted(image_pool.metrics.items(), key=lambda item: item[1].cpu, reverse=True):
+        lines.append("{name}: {0.count} jobs ({0.errors} failed), queued {queued:.2f}s avg / {0.max_queued:.2f}s max, "
+                     "CPU {cpu:.2f}s avg, {wall:.2f}s wall avg".format(
+                         metric, name=name, queued=metric.queued / metric.count,
+                         cpu=metric.cpu / max(metric.count - metric.errors, 1),
+                         wall=metric.wall / max(metric.count - metric.errors, 1)))
+
+    lines.append("image cache: {images} images, {mb:.1f}MB of {budget:.0f}MB, {0.hits} hits, {0.misses} misses".format(
+        image_cache, images=len(image_cache), mb=image_cache.nbytes / 1024 ** 2,
+        budget=image_cache.budget / 1024 ** 2))
+
+    await client.say(message, "**{running} images processing and {queued} queued in {workers} workers.**{stats}".format(
+        running=sum(image_pool.running.values()), queued=image_pool.queued, workers=image_pool.workers,
+        stats=utils.format_code("\n".join(lines))))
@@ -0,0 +1 @@
+""" Library for the image plugin. """
@@ -0,0 +1,113 @@
+""" Shared cache of downloaded images, used by the image and emoji plugins.
+
+    Images are cached as the downloaded bytes, and are decoded the first
+    time a PIL image is requested. Entries are evicted from least recently
+    used whenever the cache exceeds its budget. """
+
+from collections import OrderedDict
+from io import BytesIO
+
+from PIL import Image
+
+
+class CachedImage:
+    """ The downloaded bytes of an image, and the decoded image once requested. """
+    __slots__ = ("data", "image")
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.image = None
+
+    @property
+    def nbytes(self):
+        """ An estimate of the memory used by the entry in bytes. """
+        size = len(self.data)
+        if self.image is not None:
+            size += self.image.width * self.image.height * len(self.image.getbands())
+
+        return size
+
+
+class ImageCache:
+    """ Least recently used cache of images with a memory budget. """
+    def __init__(self, budget: int):
+        """
+        :param budget: the maximum memory used by every entry combined, in bytes. """
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key: str):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _get(self, key: str, count: bool=True):
+        entry = self.entries.get(key)
+        if entry is None:
+            if count:
+                self.misses += 1
+            return None
+
+        if count:
+            self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def get_bytes(self, key: str):
+        """ Return the bytes of a cached image, or None. Bytes are immutable,
+        so they're shared with the cache. """
+        entry = self._get(key)
+        return entry.data if entry is not None else None
+
+    def get_image(self, key: str, count: bool=True):
+        """ Return a cached image, or None. The image is decoded the first time.
+
+        The cache keeps its own image and returns a copy, so that modifying
+        the returned image never changes the cached one.
+
+        :param count: count the lookup as a hit or miss. Set to False when the
+            request was already counted, e.g right after put(). """
+        entry = self._get(key, count)
+        if entry is None:
+            return None
+
+        if entry.image is None:
+            image = Image.open(BytesIO(entry.data))
+            image.load()
+
+            self.nbytes -= entry.nbytes
+            entry.image = image
+            self.nbytes += entry.nbytes
+            self._evict(keep=key)
+
+        return entry.image.copy()
+
+    def put(self, key: str, data: bytes):
+        """ Cache the bytes of an image, replacing any image cached with the key. """
+        self.remove(key)
+        entry = self.entries[key] = CachedImage(data)
+        self.nbytes += entry.nbytes
+        self._evict(keep=key)
+
+    def remove(self, key: str):
+        """ Remove an image from the cache. """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry.nbytes
+
+    def _evict(self, keep: str):
+        """ Evict the least recently used entries, except the given key, until we're within the budget. """
+        for key in list(self.entries.keys()):
+            if self.nbytes <= self.budget:
+                break
+
+            if not key == keep:
+                self.remove(key)
+
+
+# The cache shared by every plugin
+image_cache = ImageCache(budget=64 * 1024 ** 2)
@@ -0,0 +1,129 @@
+""" Image operations for the image plugin.
+
+    Every function here takes and returns plain data, so that they can
+    be run in a worker process. An operation is a tuple of
+    (name, args, kwargs), where name is a key in the operations dict. """
+
+import time
+from io import BytesIO
+
+from PIL import Image, ImageSequence, ImageOps
+
+# Operations that keep the size of the image
+size_preserving = ("to_rgb", "invert", "transpose")
+
+# Downscales first reduce the image by an integer factor down to this many times the new size, like thumbnail()
+reducing_gap = 2.0
+
+
+def to_rgb(image: Image.Image):
+    """ Convert to RGB using solution from http://stackoverflow.com/questions/9166400/ """
+    if image.mode == "P":  # Palette images, e.g gif frames, may have a transparent color
+        image = image.convert("RGBA")
+    if not image.mode == "RGBA":
+        return image
+
+    image.load()
+    background = Image.new("RGB", image.size, (0, 0, 0))
+    background.paste(image, mask=image.split()[3])
+    return background
+
+
+def resize(image: Image.Image, size: tuple, *args, **kwargs):
+    """ Resize an image, reducing it first when supported by PIL. """
+    if hasattr(image, "reduce"):
+        kwargs.setdefault("reducing_gap", reducing_gap)
+
+    return image.resize(size, *args, **kwargs)
+
+
+operations = dict(
+    resize=resize,
+    rotate=Image.Image.rotate,
+    transpose=Image.Image.transpose,
+    invert=ImageOps.invert,
+    to_rgb=to_rgb
+)
+
+
+def apply(image: Image.Image, ops: list):
+    """ Apply a list of operations to an image, returning the new image. """
+    for name, args, kwargs in ops:
+        image = operations[name](image, *args, **kwargs)
+
+    return image
+
+
+def target_size(ops: list):
+    """ Return the size of the first resize when every operation before it keeps
+    the size of the image, otherwise None. """
+    for name, args, kwargs in ops:
+        if name == "resize":
+            return args[0] if args else kwargs["size"]
+        if name not in size_preserving:
+            break
+
+    return None
+
+
+def load(data: bytes, ops: list):
+    """ Open an image for the given operations. When they start by scaling down
+    a JPEG, it is decoded at the smallest scale still larger than the new size. """
+    image = Image.open(BytesIO(data))
+
+    size = target_size(ops)
+    if size is not None and image.format == "JPEG" and size[0] < image.width and size[1] < image.height:
+        image.draft(image.mode, size)
+
+    return image
+
+
+def process(data: bytes, ops: list, format: str, gif: bool=False, **params):
+    """ Decode an image, apply the operations and encode it again.
+
+    :param data: the encoded image.
+    :param ops: list of operations.
+    :param format: the format to encode the image in.
+    :param gif: treat the image as a sequence of frames.
+    :param params: any additional parameters sent to the writer.
+    :returns: the encoded image as bytes. """
+    image = load(data, ops)
+
+    if not gif:
+        buffer = BytesIO()
+        apply(image, ops).save(buffer, format, **params)
+        return buffer.getvalue()
+
+    # Gifs are sent as they are unless they're modified or converted
+    animated = format.upper() == "GIF"
+    if not ops and animated:
+        return data
+
+    # Modify every frame, keeping their durations and how they're disposed
+    frames, durations, disposals = [], [], []
+    for frame in ImageSequence.Iterator(image):
+        durations.append(frame.info.get("duration", image.info["duration"]))
+        disposals.append(getattr(frame, "disposal_method", 0))
+
+        modified = apply(frame, ops)
+        frames.append(modified.copy() if modified is frame else modified)
+        if not animated:  # Other formats only keep the first frame
+            break
+
+    buffer = BytesIO()
+    if animated and len(frames) > 1:
+        frames[0].save(buffer, format, save_all=True, append_images=frames[1:], duration=durations,
+                       disposal=disposals, loop=image.info.get("loop", 0), **params)
+    else:
+        frames[0].save(buffer, format, **params)
+
+    return buffer.getvalue()
+
+
+def timed(function, *args, **kwargs):
+    """ Call a function and measure the time used.
+
+    :returns: tuple of (the result, CPU time in seconds, wall time in seconds). """
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = function(*args, **kwargs)
+    return result, time.process_time() - cpu, time.perf_counter() - wall
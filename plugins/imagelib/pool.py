@@ -0,0 +1,181 @@
+""" Process pool for the image plugin.
+
+    Jobs are queued per user and started in turns, so that one user
+    sending many images does not hold up everyone else. The time spent
+    queued and the CPU time used are recorded per operation. """
+
+import asyncio
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .ops import timed
+
+
+class QueueFull(Exception):
+    """ Raised when a user has too many queued jobs. """
+    pass
+
+
+class Metric:
+    """ Totals of every job of an operation. """
+    __slots__ = ("count", "errors", "queued", "max_queued", "cpu", "wall")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.queued = 0.0
+        self.max_queued = 0.0
+        self.cpu = 0.0
+        self.wall = 0.0
+
+    def add(self, queued: float, cpu: float=0.0, wall: float=0.0, error: bool=False):
+        self.count += 1
+        self.errors += error
+        self.queued += queued
+        self.max_queued = max(self.max_queued, queued)
+        self.cpu += cpu
+        self.wall += wall
+
+
+class Job:
+    """ A queued function call. """
+    __slots__ = ("name", "function", "args", "kwargs", "future", "queued_at")
+
+    def __init__(self, name: str, function, args: tuple, kwargs: dict, future: asyncio.Future):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.queued_at = time.monotonic()
+
+
+class ImagePool:
+    """ Bounded process pool running jobs fairly between users. """
+    def __init__(self, loop: asyncio.AbstractEventLoop, workers: int=2, max_queued: int=3):
+        """
+        :param workers: the number of worker processes, which is also the number of jobs running at once.
+        :param max_queued: the maximum number of jobs queued or running per user. """
+        self.loop = loop
+        self.workers = workers
+        self.max_queued = max_queued
+        self.executor = None  # Created when the first job is started
+        self.queues = OrderedDict()  # User id -> deque of jobs, in the order users get their turn
+        self.running = {}  # User id -> number of running jobs
+        self.metrics = OrderedDict()  # Operation name -> Metric
+
+    @property
+    def queued(self):
+        """ The number of jobs waiting to be started. """
+        return sum(len(queue) for queue in self.queues.values())
+
+    def run(self, user_id: str, name: str, function, *args, **kwargs):
+        """ Queue a function to be called in a worker process. The function
+        and its arguments must be picklable.
+
+        :param user_id: the user to queue the job for.
+        :param name: the name of the operation, used in metrics.
+        :raises: QueueFull when the user has too many jobs queued or running.
+        :returns: a future of the function's result. """
+        queue = self.queues.get(user_id)
+        if (len(queue) if queue else 0) + self.running.get(user_id, 0) >= self.max_queued:
+            raise QueueFull("User {} has too many queued jobs.".format(user_id))
+
+        future = self.loop.create_future()
+        if queue is None:
+            queue = self.queues[user_id] = deque()
+        queue.append(Job(name, function, args, kwargs, future))
+
+        self._start_jobs()
+        return future
+
+    def _start_jobs(self):
+        """ Start queued jobs while there are idle workers. The user with the fewest
+        running jobs goes first, and users with as many take turns. """
+        while self.queues and sum(self.running.values()) < self.workers:
+            user_id = min(self.queues, key=lambda user_id: self.running.get(user_id, 0))
+            queue = self.queues.pop(user_id)
+            job = queue.popleft()
+            if queue:
+                self.queues[user_id] = queue  # Back of the line
+
+            if job.future.cancelled():
+                continue
+
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+            executor = self.executor
+            queued = time.monotonic() - job.queued_at
+            try:
+                task = self.loop.run_in_executor(executor, _call_timed, job.function, job.args, job.kwargs)
+            except Exception as e:  # The executor is broken or shut down, so the job never starts
+                self._metric(job.name).add(queued, error=True)
+                job.future.set_exception(e)
+                self._replace_executor(executor)
+                continue
+
+            self.running[user_id] = self.running.get(user_id, 0) + 1
+            task.add_done_callback(lambda task, user_id=user_id, job=job, queued=queued, executor=executor:
+                                   self._job_done(task, user_id, job, queued, executor))
+
+    def _metric(self, name: str):
+        """ Return the metric of an operation, creating it the first time. """
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = Metric()
+        return metric
+
+    def _replace_executor(self, executor: ProcessPoolExecutor):
+        """ Shut down a broken executor, e.g after a worker was killed, so that the next job
+        starts a fresh one. Jobs of the same executor fail together, so it's only replaced once. """
+        if self.executor is executor:
+            executor.shutdown(wait=False)
+            self.executor = None
+
+    def _job_done(self, task: asyncio.Future, user_id: str, job: Job, queued: float, executor: ProcessPoolExecutor):
+        """ Record the metrics of a finished job, and pass on the result. """
+        self.running[user_id] -= 1
+        if self.running[user_id] == 0:
+            del self.running[user_id]
+
+        metric = self._metric(job.name)
+
+        if task.cancelled():
+            metric.add(queued, error=True)
+            job.future.cancel()
+            self._start_jobs()
+            return
+
+        exception = task.exception()
+        if isinstance(exception, BrokenProcessPool):
+            self._replace_executor(executor)
+        if exception is not None:
+            metric.add(queued, error=True)
+            if not job.future.cancelled():
+                job.future.set_exception(exception)
+        else:
+            result, cpu, wall = task.result()
+            metric.add(queued, cpu, wall)
+            if not job.future.cancelled():
+                job.future.set_result(result)
+
+        self._start_jobs()
+
+    def shutdown(self):
+        """ Cancel every queued job and stop the worker processes once the running jobs are done. """
+        for queue in self.queues.values():
+            for job in queue:
+                job.future.cancel()
+        self.queues.clear()
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+def _call_timed(function, args: tuple, kwargs: dict):
+    """ Call timed() in a worker, as run_in_executor only passes positional arguments. """
+    return timed(function, *args, **kwargs)
@@ -251,7 +251,7 @@ async def check_nsfw(message: discord.Message):
         return True
 
 
-@plugins.event()
+@plugins.event(guild_only=True, check=lambda message: "nsfw" in message.content.lower())
 async def on_message(message: discord.Message):
     """ Check plugin settings. """
     # Do not check in private messages
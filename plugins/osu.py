@@ -874,7 +874,7 @@ async def find_closest_pp(beatmap_url: str, pp: float, *options):
     return c100 if closest_pp == current_pp else c100 - 1
 
 
-@plugins.command(name="pp")
+@plugins.command(name="pp", cost=5)
 async def pp_(message: discord.Message, beatmap_url: str, *options):
     """ Calculate and return the would be pp using `oppai`.
 
@@ -921,7 +921,7 @@ async def pp_(message: discord.Message, beatmap_url: str, *options):
         stars=stars_match.group(1), **data_match.groupdict()))
 
 
-osu.command(name="pp")(pp_)
+osu.command(name="pp", cost=5)(pp_)
 
 
 @osu.command(aliases="map")
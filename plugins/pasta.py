@@ -64,7 +64,7 @@ async def remove(message: discord.Message, name: Annotate.LowerContent):
                                    "here's the pasta: ```{}```".format(name, copypasta))
 
 
-@plugins.event()
+@plugins.event(prefix="|", guild_only=True)
 async def on_message(message: discord.Message):
     """ Use shorthand |<pasta ...> for displaying pastas and remove the user's message. """
     if message.content.startswith("|"):
@@ -4,10 +4,10 @@ Commands:
     pokedex
 """
 
-import os
 import logging
 from io import BytesIO
-from collections import defaultdict
+from array import array
+from collections import defaultdict, OrderedDict
 from operator import itemgetter
 from difflib import get_close_matches
 
@@ -15,7 +15,7 @@ import discord
 import json
 
 import plugins
-from pcbot import Config, permission, Annotate, command_prefix
+from pcbot import Config, permission, Annotate, command_prefix, assets
 
 try:
     from PIL import Image
@@ -41,22 +41,93 @@ with open(api_path) as api_file:
     api = json.load(api_file)
     pokedex = api["pokemon"]
 
-# Load all our sprites into RAM (they don't take much space)
+# Index the pokemon by id, by lowercase locale name and by the trigrams of their names
+pokemon_ids = {pokemon["id"]: name for name, pokemon in pokedex.items()}
+locale_names = {pokemon["locale_name"].lower(): name for name, pokemon in pokedex.items()}
+name_trigrams = defaultdict(set)
+
+# Sprites are read from disk when they're first sent
 # Unlike the pokedex.json API, these use pokemon ID as keys.
 # The values are the sprites in bytes.
-sprites = {}
-for file in os.listdir(sprites_path):
-    with open(os.path.join(sprites_path, file), "rb") as sprite_bytes:
-        sprites[int(file.split(".")[0])] = sprite_bytes.read()
+sprites = assets.AssetStore(sprites_path, key=lambda file: int(file.split(".")[0]))
+
+# Resized sprites are cached as PNG bytes, with keys of (pokemon id, scale factor)
+sprite_cache = OrderedDict()
+max_cached_sprites = 1024
+prewarm_sprites = True  # Resize the sprites of Pokemon GO pokemon for every scale factor in use when the bot is ready
+
+
+def trigrams(name: str):
+    """ Return the set of every three characters in a name, padded so that short names have trigrams. """
+    name = " {} ".format(name)
+    return set(name[i:i + 3] for i in range(len(name) - 2))
+
+
+for pokemon_name in pokedex:
+    for trigram in trigrams(pokemon_name):
+        name_trigrams[trigram].add(pokemon_name)
+
+# Type efficacy as a flat matrix, where the damage multiplier of attack_type against
+# defense_type is efficacy_matrix[type_index[attack_type] * len(type_names) + type_index[defense_type]]
+type_names = sorted(api["types"])
+type_index = {type_name: i for i, type_name in enumerate(type_names)}
+efficacy_matrix = array("d", [1.0]) * (len(type_names) ** 2)
+for attack_type, relations in api["types"].items():
+    for defense_type in relations["effective"]:
+        efficacy_matrix[type_index[attack_type] * len(type_names) + type_index[defense_type]] = 2.0
+    for defense_type in relations["ineffective"]:
+        efficacy_matrix[type_index[attack_type] * len(type_names) + type_index[defense_type]] = 0.5
+
+# Sorted locale names of pokemon by their types, where (slot_1, None) includes every
+# pokemon with slot_1 as their first type, and by the distance of the egg they hatch from
+pokemon_by_types = defaultdict(list)
+egg_pokemon = defaultdict(list)
+for pokemon in sorted(pokedex.values(), key=itemgetter("locale_name")):
+    pokemon_by_types[(pokemon["types"][0], None)].append(pokemon["locale_name"])
+    if len(pokemon["types"]) > 1:
+        pokemon_by_types[tuple(pokemon["types"])].append(pokemon["locale_name"])
+
+    if "hatches_from" in pokemon and pokemon["generation"] in pokemon_go_gen:
+        egg_pokemon[pokemon["hatches_from"]].append(pokemon["locale_name"])
+
+
+def close_matches(name: str, n: int=3, cutoff: float=0.6):
+    """ Return the names of the pokemon closest to the given name, like
+    difflib.get_close_matches. Only pokemon sharing a trigram with the name are compared. """
+    candidates = set()
+    for trigram in trigrams(name):
+        candidates.update(name_trigrams.get(trigram, ()))
+
+    return get_close_matches(name, candidates, n=n, cutoff=cutoff)
+
+
+def efficacy(attack_type: str, defense_type: str):
+    """ Return the damage multiplier of an attack type against a defending type. """
+    return efficacy_matrix[type_index[attack_type] * len(type_names) + type_index[defense_type]]
+
+
+def attack_multipliers(attack_type: str):
+    """ Return a list of (defending type, multiplier) for an attack type. """
+    row = type_index[attack_type] * len(type_names)
+    return list(zip(type_names, efficacy_matrix[row:row + len(type_names)]))
+
+
+def defense_multipliers(types: list):
+    """ Return a list of (attack type, multiplier) against a pokemon with the given types.
+    The multipliers of every type are combined. """
+    multipliers = []
+    for attack_type in type_names:
+        multiplier = 1.0
+        for defense_type in types:
+            multiplier *= efficacy(attack_type, defense_type)
+        multipliers.append((attack_type, multiplier))
+
+    return multipliers
 
 
 def id_to_name(pokemon_id: int):
     """ Convert the pokemon ID to a name. """
-    for name, pokemon in pokedex.items():
-        if pokemon["id"] == pokemon_id:
-            return name
-
-    return None
+    return pokemon_ids.get(pokemon_id)
 
 
 def egg_name(pokemon_evolution: list):
@@ -74,7 +145,7 @@ def egg_name(pokemon_evolution: list):
 
 
 def resize_sprite(sprite, factor: float):
-    """ Resize a sprite (string of bytes / rb). """
+    """ Resize a sprite (string of bytes / rb) and return the PNG bytes. """
     image = Image.open(BytesIO(sprite))
 
     # Resize with the scaled proportions
@@ -82,11 +153,53 @@ def resize_sprite(sprite, factor: float):
     width, height = int(width * factor), int(height * factor)
     image = image.resize((width, height), Image.NEAREST)
 
-    # Return the byte-like object
+    # Return the bytes
     buffer = BytesIO()
     image.save(buffer, "PNG")
-    buffer.seek(0)
-    return buffer
+    return buffer.getvalue()
+
+
+def get_sprite(pokemon_id: int, factor: float):
+    """ Return the sprite of a pokemon as PNG bytes, resized with the given factor
+    if PIL is enabled. Resized sprites are cached. """
+    sprite = sprites[pokemon_id] if pokemon_id in sprites else sprites[0]
+    factor = round(factor, 2)
+    if not resize or factor == 1:
+        return sprite
+
+    key = (pokemon_id, factor)
+    if key in sprite_cache:
+        sprite_cache.move_to_end(key)
+        return sprite_cache[key]
+
+    sprite = resize_sprite(sprite, factor)
+    cache_sprite(key, sprite)
+    return sprite
+
+
+def cache_sprite(key: tuple, sprite: bytes):
+    """ Cache a resized sprite, removing the least recently used sprites when the cache is full. """
+    sprite_cache[key] = sprite
+    sprite_cache.move_to_end(key)
+    while len(sprite_cache) > max_cached_sprites:
+        sprite_cache.popitem(last=False)
+
+
+def scale_factors():
+    """ Return the set of scale factors used by any server, rounded like the keys in sprite_cache. """
+    factors = set(round(data["scale-factor"], 2) for data in pokedex_config.data.values() if "scale-factor" in data)
+    factors.add(round(default_scale_factor, 2))
+    return factors
+
+
+def uncache_scale_factor(factor: float):
+    """ Remove the cached sprites resized with a factor no longer used by any server. """
+    factor = round(factor, 2)
+    if factor in scale_factors():
+        return
+
+    for key in [key for key in sprite_cache if key[1] == factor]:
+        del sprite_cache[key]
 
 
 def format_type(types: list):
@@ -116,18 +229,16 @@ async def pokedex_(message: discord.Message, name_or_id: Annotate.LowerCleanCont
         pokemon_id = int(name_or_id)
     except ValueError:
         # See if there's a pokemon with the locale name formatted like the given name
-        for pokemon in pokedex.values():
-            if pokemon["locale_name"].lower() == name:
-                name = pokemon["name"]
-                break
+        name = locale_names.get(name, name)
 
         # Correct the name if it is very close to an existing pokemon and there's only one close match
-        matches = get_close_matches(name, pokedex.keys(), n=2, cutoff=0.8)
-        if matches and len(matches) == 1:
-            name = matches[0]
+        if name not in pokedex:
+            matches = close_matches(name, n=2, cutoff=0.8)
+            if matches and len(matches) == 1:
+                name = matches[0]
 
         assert name in pokedex, "There is no pokémon called **{}** in my pokédex!\nPerhaps you meant: `{}`?".format(
-            name, ", ".join(get_close_matches(name, pokedex.keys(), cutoff=0.5)))
+            name, ", ".join(close_matches(name, cutoff=0.5)))
     else:
         name = id_to_name(pokemon_id)
         assert name is not None, "There is no pokémon with ID **#{:03}** in my pokédex!".format(pokemon_id)
@@ -142,18 +253,9 @@ async def pokedex_(message: discord.Message, name_or_id: Annotate.LowerCleanCont
     # Assign our pokemon
     pokemon = pokedex[name]
 
-    # Assign the sprite to use
-    if pokemon["id"] in sprites:
-        sprite = sprites[pokemon["id"]]
-    else:
-        sprite = sprites[0]
-
     # Resize (if PIL is enabled) and upload the sprite
-    if resize and not round(scale_factor, 2) == 1:
-        sprite = resize_sprite(sprite, scale_factor)
-    elif resize:
-        sprite = BytesIO(sprite)
-    await client.send_file(message.channel, sprite, filename="{}.png".format(name))
+    sprite = get_sprite(pokemon["id"], scale_factor)
+    await client.send_file(message.channel, BytesIO(sprite), filename="{}.png".format(name))
 
     # Format Pokemon GO specific info
     pokemon_go_info = ""
@@ -200,31 +302,13 @@ async def egg(message: discord.Message, egg_type: Annotate.LowerCleanContent):
         await client.say(message, "The egg type **{}** is invalid.".format(egg_type))
         return
 
-    pokemon_criteria = []
-    egg_types = []
-
-    # Find all pokemon with the specified distance
-    for pokemon in sorted(pokedex.values(), key=itemgetter("id")):
-        # We've exceeded the generation and no longer need to search
-        if pokemon["generation"] not in pokemon_go_gen:
-            break
-
-        if "hatches_from" not in pokemon:
-            continue
-
-        if pokemon["hatches_from"] not in egg_types:
-            egg_types.append(pokemon["hatches_from"])
-
-        if pokemon["hatches_from"] == distance:
-            pokemon_criteria.append(pokemon["locale_name"])
-
     # The list might be empty
-    assert pokemon_criteria, "No pokemon hatch from a **{}km** egg. **Valid distances are** ```\n{}```".format(
-        distance, ", ".join("{}km".format(s) for s in sorted(egg_types)))
+    assert distance in egg_pokemon, "No pokemon hatch from a **{}km** egg. **Valid distances are** ```\n{}```".format(
+        distance, ", ".join("{}km".format(s) for s in sorted(egg_pokemon)))
 
     # Respond with the list of matching criteria
     await client.say(message, "**The following Pokémon may hatch from a {}km egg**:```\n{}```".format(
-        distance, ", ".join(sorted(pokemon_criteria))))
+        distance, ", ".join(egg_pokemon[distance])))
 
 
 def assert_type(slot: str):
@@ -247,59 +331,42 @@ def format_efficacy(types: list):
     multiple commands. """
     efficacy = ""
     for type_name in types:
+        offensive = attack_multipliers(type_name)
         efficacy += \
             "**{0} OFFENSIVE**\n" \
             "Super effective against: `{1}`\n" \
             "Not very effective against: `{2}`\n".format(
                 type_name.upper(),
-                ", ".join(s.capitalize() for s in sorted(api["types"][type_name]["effective"])) or "None",
-                ", ".join(s.capitalize() for s in sorted(api["types"][type_name]["ineffective"])) or "None")
-
-        # Find any type which is effective and ineffective against type_name
-        effective, ineffective = [], []
-        for other_type_name in api["types"]:
-            if type_name in api["types"][other_type_name]["effective"]:
-                effective.append(other_type_name)
-            elif type_name in api["types"][other_type_name]["ineffective"]:
-                ineffective.append(other_type_name)
+                ", ".join(s.capitalize() for s, multiplier in offensive if multiplier > 1) or "None",
+                ", ".join(s.capitalize() for s, multiplier in offensive if multiplier < 1) or "None")
 
+        defensive = defense_multipliers([type_name])
         efficacy += \
             "**{0} DEFENSIVE**\n" \
             "Not very effective against {1} type: `{2}`\n" \
             "Super effective against {1} type: `{3}`\n".format(
                 type_name.upper(),
                 type_name,
-                ", ".join(s.capitalize() for s in sorted(ineffective)) or "None",
-                ", ".join(s.capitalize() for s in sorted(effective)) or "None")
+                ", ".join(s.capitalize() for s, multiplier in defensive if multiplier < 1) or "None",
+                ", ".join(s.capitalize() for s, multiplier in defensive if multiplier > 1) or "None")
     return efficacy.strip("\n")
 
 
 @pokedex_.command(name="type", description="Show pokemon with the specified types. {}".format(types_str))
 async def filter_type(message: discord.Message, slot_1: str.lower, slot_2: str.lower=None):
-    matched_pokemon = []
     assert_type(slot_1)
-
-    # Find all pokemon with the matched criteria
     if slot_2:
         assert_type(slot_2)
 
-        # If two slots are provided, search for pokemon with both types matching
-        for pokemon in pokedex.values():
-            if pokemon["types"] == [slot_1, slot_2]:
-                matched_pokemon.append(pokemon["locale_name"])
-    else:
-        # All pokemon have a type in their first slot, so check if these are equal
-        for pokemon in pokedex.values():
-            if pokemon["types"][0] == slot_1:
-                matched_pokemon.append(pokemon["locale_name"])
-
+    # When only one slot is provided, every pokemon with the type in their first slot is matched
+    matched_pokemon = pokemon_by_types.get((slot_1, slot_2 or None))
     types = [slot_1] if slot_2 is None else [slot_1, slot_2]
 
     # There might not be any pokemon with the specified types
     assert matched_pokemon, "Looks like there are no pokemon of type **{}**!".format(format_type(types))
 
     await client.say(message, "**Pokemon with type {}**: ```\n{}```".format(
-        format_type(types), ", ".join(sorted(matched_pokemon))))
+        format_type(types), ", ".join(matched_pokemon)))
 
 
 @pokedex_.command(aliases="e",
@@ -310,6 +377,42 @@ async def effect(message: discord.Message, type: str.lower):
     await client.say(message, format_efficacy([type]))
 
 
+def format_multipliers(multipliers: list):
+    """ Format a list of (type, multiplier) grouped by multiplier, highest first. """
+    groups = defaultdict(list)
+    for type_name, multiplier in multipliers:
+        groups[multiplier].append(type_name.capitalize())
+
+    return "\n".join("{:g}x: {}".format(multiplier, ", ".join(groups[multiplier]))
+                     for multiplier in sorted(groups, reverse=True))
+
+
+@pokedex_.command(aliases="c", description="Display the types the specified attack types are most effective against. "
+                                           "{}".format(types_str))
+async def coverage(message: discord.Message, *types: str.lower):
+    assert types, "Please specify at least one type."
+    for type_name in types:
+        assert_type(type_name)
+
+    # The best multiplier of any of the attack types against every defending type
+    multipliers = [(defense_type, max(efficacy(attack_type, defense_type) for attack_type in types))
+                   for defense_type in type_names]
+
+    await client.say(message, "**Coverage of type {}**: ```\n{}```".format(
+        format_type(types), format_multipliers(multipliers)))
+
+
+@pokedex_.command(aliases="w", description="Display the damage multipliers against a pokemon with the specified types. "
+                                           "{}".format(types_str))
+async def weakness(message: discord.Message, slot_1: str.lower, slot_2: str.lower=None):
+    types = [slot_1] if slot_2 is None else [slot_1, slot_2]
+    for type_name in types:
+        assert_type(type_name)
+
+    await client.say(message, "**Damage taken by type {}**: ```\n{}```".format(
+        format_type(types), format_multipliers(defense_multipliers(types))))
+
+
 @permission("manage_server")
 @pokedex_.command(disabled_pm=True, aliases="sf")
 async def scalefactor(message: discord.Message, factor: float=default_scale_factor):
@@ -322,6 +425,7 @@ async def scalefactor(message: discord.Message, factor: float=default_scale_fact
 
     if message.server.id not in pokedex_config.data:
         pokedex_config.data[message.server.id] = {}
+    old_factor = pokedex_config.data[message.server.id].get("scale-factor", default_scale_factor)
 
     # Handle specific scenarios
     if factor == default_scale_factor:
@@ -335,4 +439,25 @@ async def scalefactor(message: discord.Message, factor: float=default_scale_fact
         reply = "Pokédex image scale factor set to **{factor}**."
 
     pokedex_config.save()
+    uncache_scale_factor(old_factor)
     await client.say(message, reply.format(factor=factor))
+
+
+async def on_ready():
+    """ Resize the sprites of every Pokemon GO pokemon for every scale factor in use,
+    so that they're cached before anyone asks. """
+    if not resize or not prewarm_sprites:
+        return
+
+    go_pokemon_ids = sorted(pokemon["id"] for pokemon in pokedex.values() if pokemon["generation"] in pokemon_go_gen)
+    for factor in scale_factors():
+        if factor == 1:
+            continue
+
+        for pokemon_id in go_pokemon_ids:
+            key = (pokemon_id, factor)
+            if key in sprite_cache or pokemon_id not in sprites or len(sprite_cache) >= max_cached_sprites:
+                continue
+
+            sprite = await client.loop.run_in_executor(None, resize_sprite, sprites[pokemon_id], factor)
+            cache_sprite(key, sprite)
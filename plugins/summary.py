@@ -1,25 +1,49 @@
 """ Plugin for generating markov text, or a summary if you will. """
 
 
-import random
+import logging
 import re
-from collections import defaultdict, deque
-from functools import partial
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone
 
 import asyncio
 import discord
 
 from pcbot import utils, Annotate, config, Config
 import plugins
+from plugins.summarylib import filters, markov, store
 client = plugins.client  # type: discord.Client
 
 
+summary_options = Config("summary_options", data=dict(no_bot=False, no_self=False, memory_budget_mb=128),
+                         pretty=True)
+
 # The messages stored per session, where every key is a channel id
-stored_messages = defaultdict(partial(deque, maxlen=10000))
+# Stored messages are persisted in messages_path and loaded the first time a channel is summarized
+max_stored_messages = 10000
+markov_order = 1  # Set to 2 for chains of two word keys, falling back to one
+messages_path = Config.config_path + "summary_messages/"
+corpora = store.CorpusStore(budget=summary_options.data["memory_budget_mb"] * 1024 ** 2,
+                            capacity=max_stored_messages, order=markov_order, path=messages_path)
+update_tasks = {}  # Tasks syncing a channel's messages, where every key is a channel id
+budget_check_interval = 1000  # The number of stored messages between each memory budget check
+messages_since_check = 0
 logs_from_limit = 5000
 max_summaries = 5
-update_task = asyncio.Event()
-update_task.set()
+max_message_length = 2000
+
+# Summaries are generated in a pool of threads so that large channels don't block the bot
+summary_workers = 2  # The number of summary requests generated at once
+summary_time_budget = 5  # The time in seconds a summary request may take, including time spent queued
+
+# Stop the threads of the previous pools when the plugin is reloaded, finishing any queued writes
+if "executor" in globals():
+    executor.shutdown(wait=False)
+    io_executor.shutdown(wait=True)
+
+executor = ThreadPoolExecutor(max_workers=summary_workers)
+io_executor = ThreadPoolExecutor(max_workers=1)  # Reads and writes the message files in order
 
 # Define some regexes for option checking in "summary" command
 valid_num = re.compile(r"\*(?P<num>\d+)")
@@ -30,158 +54,169 @@ valid_options = ("+re", "+regex", "+case", "+tts", "+nobot", "+bot")
 
 on_no_messages = "**There were no messages to generate a summary from, {0.author.name}.**"
 on_fail = "**I was unable to construct a summary, {0.author.name}.**"
+on_crash = "**The given phrase would crash the bot.**"
+on_timeout = "**Generating the summary took too long, {0.author.name}.**"
 
-summary_options = Config("summary_options", data=dict(no_bot=False, no_self=False), pretty=True)
 
+def is_command(content: str):
+    """ Return True if the message content looks like a command. """
+    return content.startswith(config.command_prefix)
 
-async def update_messages(channel: discord.Channel):
-    """ Download messages. """
-    messages = stored_messages[channel.id]  # type: deque
 
-    # We only want to log messages when there are none
-    # Any messages after this logging will be logged in the on_message event
-    if messages:
-        return
+def store_message(corpus: store.Corpus, message: discord.Message):
+    """ Store a message in the corpus, and index it unless it's a command. """
+    content = message.clean_content
+    timestamp = message.timestamp.replace(tzinfo=timezone.utc).timestamp()
+    corpus.append(int(message.id), int(message.author.id), message.author.bot, timestamp, content,
+                  index=not is_command(content))
 
-    # Make sure not to download messages twice by setting this handy task
-    update_task.clear()
 
-    # Download logged messages
+def enforce_budget():
+    """ Evict the least recently used channels when we exceed the memory budget. """
+    global messages_since_check
+    messages_since_check = 0
+
+    evicted = corpora.enforce_budget()
+    if evicted:
+        logging.debug("Evicted stored summary messages of {} channels".format(len(evicted)))
+        client.loop.run_in_executor(io_executor, store.write_unsaved, corpora.take_unsaved())
+
+
+async def sync_messages(channel: discord.Channel, corpus: store.Corpus):
+    """ Load the persisted messages and download any newer messages. """
+    corpus.pending = []
+
+    # Download logged messages until we find the newest persisted message
+    downloaded = []
     try:
+        records, corpus.persisted = await client.loop.run_in_executor(io_executor, store.load_records, corpus.path,
+                                                                      corpus.capacity)
+        for record in records:
+            corpus.append(*record, index=not is_command(record[4]), save=False)
+
+        last_id = corpus.buffer.last_id
         async for m in client.logs_from(channel, limit=logs_from_limit):
+            if last_id is not None and int(m.id) <= last_id:
+                break
             if not m.content:
                 continue
 
-            # We have no messages, so insert each from the left, leaving us with the oldest at index -1
-            messages.appendleft(m)
-    except:  # When something goes wrong, clear the messages
-        messages.clear()
-    finally:  # Really have to make sure we clear this task in all cases
-        update_task.set()
+            downloaded.append(m)
+    except:  # When something goes wrong, clear the messages and try again next time
+        corpus.reset()
+        return
+    finally:  # Really have to make sure we stop receiving messages in all cases
+        received, corpus.pending = corpus.pending, None
 
+    # The logs are downloaded newest first, and any message received in the meantime is even newer
+    for m in reversed(downloaded):
+        store_message(corpus, m)
+    for m in received:
+        if corpus.buffer.last_id is None or int(m.id) > corpus.buffer.last_id:
+            store_message(corpus, m)
 
-@plugins.event(bot=True, self=True)
-async def on_message(message: discord.Message):
-    """ Whenever a message is sent, see if we can update in one of the channels. """
-    if message.channel.id in stored_messages and message.content:
-        stored_messages[message.channel.id].append(message)
+    corpus.synced = True
+    enforce_budget()
 
 
-def is_valid_option(arg: str):
-    if valid_num.match(arg) or valid_member.match(arg) or valid_member_silent.match(arg) or valid_channel.match(arg):
-        return True
-
-    if arg.lower() in valid_options:
-        return True
-
-    return False
-
+async def update_messages(channel: discord.Channel):
+    """ Make sure the channel's messages are loaded and return its corpus.
+    Any messages after this will be stored in the on_message event. """
+    corpus = corpora.get(channel.id)
+    if corpus.synced:
+        return corpus
 
-def indexes_of_word(words: list, word: str):
-    """ Return a list of indexes with the given word. """
-    return [i for i, s in enumerate(words) if s.lower() == word]
+    # Make sure not to download messages twice by sharing the task with any other summary in this channel
+    if channel.id not in update_tasks:
+        task = update_tasks[channel.id] = client.loop.create_task(sync_messages(channel, corpus))
+        task.add_done_callback(lambda _: update_tasks.pop(channel.id, None))
 
+    await asyncio.shield(update_tasks[channel.id])
+    return corpus
 
-def random_with_bias(messages: list, word: str):
-    """ Go through all the messages and try to choose the ones where the given word is
-    not at the end of the string. """
-    last_word_messages = []
-    non_last_word_messages = []
-    for m in messages:
-        words = m.split()
-        if words[-1].lower() == word:
-            last_word_messages.append(m)
-        else:
-            non_last_word_messages.append(m)
 
-    if not last_word_messages:
-        return random.choice(non_last_word_messages)
-    elif not non_last_word_messages:
-        return random.choice(last_word_messages)
-    else:
-        return random.choice(last_word_messages if random.randint(0, 5) == 0 else non_last_word_messages)
+@plugins.event(bot=True, self=True, check=lambda message: message.channel.id in corpora)
+async def on_message(message: discord.Message):
+    """ Whenever a message is sent, see if we can update in one of the channels. """
+    global messages_since_check
+    if not message.content:
+        return
 
+    corpus = corpora.peek(message.channel.id)
+    if corpus is None:
+        return
 
-def markov_messages(messages, coherent=False):
-    """ Generate some kind of markov chain that somehow works with discord.
-    I found this makes better results than markovify would. """
-    imitated = []
-    word = ""
+    # Keep the message for later if we're downloading the channel's logs
+    if corpus.pending is not None:
+        corpus.pending.append(message)
+    elif corpus.synced:
+        store_message(corpus, message)
 
-    if all(True if s.startswith("@") or s.startswith("http") else False for s in messages):
-        return "**The given phrase would crash the bot.**"
+        messages_since_check += 1
+        if messages_since_check >= budget_check_interval:
+            enforce_budget()
 
-    # First word
-    while True:
-        m_split = random.choice(messages).split()
-        if not m_split:
-            continue
 
-        # Choose the first word in the sentence to simulate a markov chain
-        word = m_split[0]
-
-        if not word.startswith("@") and not word.startswith("http"):
-            break
-
-    # Add the first word
-    imitated.append(word)
-    valid = []
-    im = ""
-
-    # Next words
-    while True:
-        # Set the last word and find all messages with the last word in it
-        if not im == imitated[-1].lower():
-            im = imitated[-1].lower()
-            valid = [m for m in messages if im in m.lower().split()]
-
-        # Add a word from the message found
-        if valid:
-            # # Choose one of the matched messages and split it into a list or words
-            m = random_with_bias(valid, im).split()
-            m_indexes = indexes_of_word(m, im)
-            m_index = random.choice(m_indexes)  # Choose a random index
-            m_from = m[m_index:]
-
-            # Are there more than the matched word in the message (is it not the last word?)
-            if len(m_from) > 1:
-                imitated.append(m_from[1])  # Then we'll add the next word
-                continue
-            else:
-                # Have the chance of breaking be 1/4 at start and 1/1 when imitated approaches 150 words
-                # unless the entire summary should be coherent
-                chance = 0 if coherent else int(-0.02 * len(imitated) + 4)
-                chance = chance if chance >= 0 else 0
+def is_valid_option(arg: str):
+    if valid_num.match(arg) or valid_member.match(arg) or valid_member_silent.match(arg) or valid_channel.match(arg):
+        return True
 
-                if random.randint(0, chance) == 0:
-                    break
+    if arg.lower() in valid_options:
+        return True
 
-        # Add a random word if all valid messages are one word or there are less than 2 messages
-        if len(valid) <= 1 or all(len(m.split()) <= 1 for m in valid):
-            seq = random.choice(messages).split()
-            word = random.choice(seq)
-            imitated.append(word)
+    return False
 
-    # Remove links after, because you know
-    imitated = [s for s in imitated if "http://" not in s and "https://" not in s]
 
-    return " ".join(imitated)
+def make_filter(member: list, phrase: str, regex: bool, case: bool, bots: bool):
+    """ Return a filter of stored messages matching the given options. """
+    # An empty list of members matches every author, so members that weren't found can't just be left out
+    assert None not in member, "**Could not find that member.**"
 
+    try:
+        return filters.MessageFilter(
+            member_ids=(int(m.id) for m in member), phrase=phrase, regex=regex, case=case, bots=bots,
+            exclude_author=int(client.user.id) if summary_options.data["no_self"] else None,
+            command_prefix=config.command_prefix)
+    except re.error:
+        raise AssertionError("**Invalid regex.**")
+
+
+def generate_summaries(chain: markov.MarkovChain, num: int, deadline: float, buffer: store.MessageBuffer=None,
+                       message_filter: filters.MessageFilter=None):
+    """ Generate up to num summaries, stopping early when the deadline passes.
+    This runs in the executor, so the chain must be a snapshot.
+
+    :param buffer: when given, the chain is built from the messages in the buffer passing the filter.
+    :raises: filters.FilterTimeout when the deadline passes while filtering.
+    :returns: tuple of (chain, list of summaries), where a summary is None when there was no word to start with.
+        The chain is None when the deadline passed while the request was queued. """
+    # Requests that spent their time waiting for a worker are dropped before doing any work
+    if time.monotonic() >= deadline:
+        return None, []
+
+    if buffer is not None:
+        chain = markov.MarkovChain.from_messages(message_filter(buffer, deadline), order=markov_order)
+
+    summaries = []
+    while chain and len(summaries) < num and time.monotonic() < deadline:
+        summaries.append(chain.generate())
+
+    return chain, summaries
+
+
+def join_summaries(summaries: list):
+    """ Join summaries into as few messages as possible. """
+    messages = [summaries[0]]
+    for summary in summaries[1:]:
+        if len(messages[-1]) + len(summary) + 1 > max_message_length:
+            messages.append(summary)
+        else:
+            messages[-1] += "\n" + summary
 
-def filter_messages(message_content: list, phrase: str, regex: bool=False, case: bool=False):
-    """ Filter messages by searching and yielding each message. """
-    for content in message_content:
-        if regex:
-            try:
-                if re.search(phrase, content, 0 if case else re.IGNORECASE):
-                    yield content
-            except:  # Return error message when regex does not work
-                raise AssertionError("**Invalid regex.**")
-        elif not regex and (phrase in content if case else phrase.lower() in content.lower()):
-            yield content
+    return messages
 
 
-@plugins.command(usage="[*<num>] [@<user> ...] [#<channel>] [+re(gex)] [+case] [+tts] [+(no)bot] [phrase ...]",
+@plugins.command(cost=3, usage="[*<num>] [@<user> ...] [#<channel>] [+re(gex)] [+case] [+tts] [+(no)bot] [phrase ...]",
                  pos_check=is_valid_option)
 async def summary(message: discord.Message, *options, phrase: Annotate.Content=None):
     """ Perform a summary! """
@@ -238,36 +273,53 @@ async def summary(message: discord.Message, *options, phrase: Annotate.Content=N
         channel = message.channel
 
     await client.send_typing(message.channel)
-    await update_task.wait()
-    await update_messages(channel)
-
-    # Split the messages into content and filter member and phrase
-    if member:
-        messages = [m for m in stored_messages[channel.id] if m.author in member]
-    else:
-        messages = [m for m in stored_messages[channel.id]]
-
-    # Filter bot messages or own messages if the option is enabled in the config
-    if not bots:
-        messages = [m for m in messages if not m.author.bot]
-    elif summary_options.data["no_self"]:
-        messages = [m for m in messages if not m.author.id == client.user.id]
+    corpus = await update_messages(channel)
 
-    # Convert all messages to content
-    message_content = [m.clean_content for m in messages]
+    # Filtered chains are built in the executor from a copy of the messages, and cached until new messages arrive
+    message_filter = make_filter(member, phrase, regex, case, bots)
+    chain = corpus.get_view(message_filter)
+    buffer = corpus.buffer.copy() if chain is None else None
+    deadline = time.monotonic() + summary_time_budget
 
-    # Filter looking for phrases if specified
-    if phrase:
-        message_content = list(filter_messages(message_content, phrase, regex, case))
+    try:
+        chain, summaries = await client.loop.run_in_executor(
+            executor, generate_summaries, chain.snapshot() if chain is not None else None, num, deadline, buffer,
+            message_filter)
+    except filters.FilterTimeout:
+        assert time.monotonic() < deadline, on_timeout.format(message)
+        raise AssertionError("**The given phrase takes too long to search for.**")
 
-    # Clean up by removing all commands from the summaries
-    if phrase is None or not phrase.startswith(config.command_prefix):
-        message_content = [s for s in message_content if not s.startswith(config.command_prefix)]
+    assert chain is not None, on_timeout.format(message)
+    if buffer is not None:
+        corpus.set_view(message_filter, buffer.count, chain)
 
     # Check if we even have any messages
-    assert message_content, on_no_messages.format(message)
-
-    # Generate the summary, or num summaries
-    for i in range(num):
-        sentence = markov_messages(message_content)
-        await client.send_message(message.channel, sentence or on_fail.format(message), tts=tts)
+    assert chain, on_no_messages.format(message)
+    assert summaries, on_timeout.format(message)
+
+    # Send every summary at once, unless they're too long for one message
+    summaries = [on_crash if sentence is None else sentence or on_fail.format(message) for sentence in summaries]
+    for content in join_summaries(summaries):
+        await client.send_message(message.channel, content, tts=tts)
+
+
+async def save(loaded_plugins: dict):
+    """ Append every stored message that is not yet persisted to their files. """
+    await client.loop.run_in_executor(io_executor, store.write_unsaved, corpora.take_unsaved())
+
+
+@plugins.command(hidden=True)
+@utils.owner
+async def summarymemory(message: discord.Message, num: utils.int_range(f=1)=10):
+    """ Display the memory used by the channels with the most stored messages. """
+    now = time.monotonic()
+    lines = []
+    for corpus in corpora.usage()[:num]:
+        channel = client.get_channel(corpus.channel_id)
+        lines.append("{name}: {messages} messages, {kb:.1f}kB, used {minutes:.0f} minutes ago".format(
+            name="#{0} ({0.server})".format(channel) if channel else corpus.channel_id,
+            messages=len(corpus), kb=corpus.nbytes / 1024, minutes=(now - corpus.last_used) / 60))
+
+    await client.say(message, "**Stored messages in {channels} channels use {mb:.2f}MB of {budget}MB.**{usage}".format(
+        channels=len(corpora), mb=corpora.nbytes / 1024 ** 2, budget=summary_options.data["memory_budget_mb"],
+        usage=utils.format_code("\n".join(lines)) if lines else ""))
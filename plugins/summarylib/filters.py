@@ -0,0 +1,161 @@
+""" Message filters for the summary plugin.
+
+    A filter is built once from the summary options and applied to every
+    stored message in a single pass. Regular expressions are compiled
+    once and guarded against catastrophic backtracking: with the regex
+    module every search has a timeout, and without it patterns that may
+    backtrack exponentially are rejected. """
+
+import re
+import time
+
+# The regex module supports timeouts on every search, which is preferred when installed
+try:
+    import regex as regex_module
+except ImportError:
+    regex_module = None
+
+
+search_timeout = 0.05  # The time in seconds a single regex search may take, when the regex module is installed
+filter_timeout = 1  # The time in seconds filtering every message may take
+
+
+def has_ambiguous_repeat(pattern: str):
+    """ Return True when a repeated group contains a quantifier or an alternation,
+    e.g (a+)+, (\w*)* or (a|aa)*, which the re module may backtrack exponentially on. """
+    groups = []  # Whether each open group contains a quantifier or alternation
+    ambiguous = False  # Whether the group that was just closed contains one
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        closed = False
+        if char == "\\":
+            i += 1
+        elif char == "[":
+            # Skip the character class, where a ] right after the [ or [^ is a literal
+            i += 2 if pattern.startswith("[^", i) else 1
+            if pattern.startswith("]", i):
+                i += 1
+            while i < len(pattern) and pattern[i] != "]":
+                i += 2 if pattern[i] == "\\" else 1
+        elif char == "(":
+            groups.append(False)
+        elif char == ")" and groups:
+            ambiguous = groups.pop()
+            if groups:
+                groups[-1] = groups[-1] or ambiguous
+            closed = True
+        elif char in "*+{" or char == "?" and pattern[i - 1] != "(":
+            if groups:
+                groups[-1] = True
+        elif char == "|" and groups:
+            groups[-1] = True
+
+        i += 1
+        if closed and ambiguous and i < len(pattern) and pattern[i] in "*+{":
+            return True
+
+    return False
+
+
+class FilterTimeout(Exception):
+    """ Raised when filtering takes too long. """
+    pass
+
+
+def compile_pattern(phrase: str, case: bool=False):
+    """ Compile a regex pattern.
+
+    :raises: re.error when the pattern is invalid, or when the pattern risks
+        catastrophic backtracking and cannot be searched with a timeout. """
+    flags = 0 if case else re.IGNORECASE
+
+    if regex_module is not None:
+        try:
+            return regex_module.compile(phrase, flags)
+        except regex_module.error as e:
+            raise re.error(str(e))
+
+    if has_ambiguous_repeat(phrase):
+        raise re.error("repeated groups with quantifiers or alternations are not supported")
+
+    return re.compile(phrase, flags)
+
+
+class MessageFilter:
+    """ Filter of stored messages by the summary options. """
+    def __init__(self, member_ids=(), phrase: str=None, regex: bool=False, case: bool=False, bots: bool=True,
+                 exclude_author: int=None, command_prefix: str=None):
+        """
+        :param member_ids: only include messages by these authors, or every author if empty.
+        :param phrase: only include messages with this phrase.
+        :param regex: the phrase is a regex pattern.
+        :param case: the phrase is case sensitive.
+        :param bots: include messages by bots.
+        :param exclude_author: exclude messages by this author.
+        :param command_prefix: exclude messages starting with this prefix, unless the phrase does.
+        :raises: re.error when the regex pattern can't be used, see compile_pattern(). """
+        self.member_ids = frozenset(member_ids)
+        self.phrase = phrase or None
+        self.regex = regex and self.phrase is not None
+        self.case = case
+        self.bots = bots
+        self.exclude_author = exclude_author if bots else None
+        self.command_prefix = command_prefix
+        if self.phrase and command_prefix and self.phrase.startswith(command_prefix):
+            self.command_prefix = None
+
+        self.pattern = compile_pattern(self.phrase, case) if self.regex else None
+        if self.phrase and not self.regex and not case:
+            self.phrase = self.phrase.lower()
+
+    @property
+    def key(self):
+        """ A key of the options, for caching the filtered messages. """
+        return (self.member_ids, self.phrase, self.regex, self.case, self.bots, self.exclude_author,
+                self.command_prefix)
+
+    @property
+    def is_default(self):
+        """ Whether this filter only excludes commands, like a corpus' own markov chain. """
+        return not (self.member_ids or self.phrase or not self.bots or self.exclude_author is not None) \
+            and self.command_prefix is not None
+
+    def _search(self, content: str):
+        if self.pattern is None:
+            return self.phrase in (content if self.case else content.lower())
+
+        if regex_module is not None:
+            try:
+                return self.pattern.search(content, timeout=search_timeout) is not None
+            except TimeoutError:
+                raise FilterTimeout("Searching a message took too long.")
+
+        return self.pattern.search(content) is not None
+
+    def __call__(self, messages, deadline: float=None):
+        """ Yield the content of every message passing the filter.
+
+        :param messages: an iterable of records with author_id, bot and content attributes.
+        :param deadline: a time.monotonic() time to stop filtering at, when sooner than filter_timeout.
+        :raises: FilterTimeout when filtering takes longer than filter_timeout or passes the deadline. """
+        timeout = time.monotonic() + filter_timeout
+        deadline = timeout if deadline is None else min(deadline, timeout)
+
+        for m in messages:
+            if time.monotonic() > deadline:
+                raise FilterTimeout("Filtering messages took too long.")
+            if self.member_ids and m.author_id not in self.member_ids:
+                continue
+            if not self.bots and m.bot:
+                continue
+            if self.exclude_author is not None and m.author_id == self.exclude_author:
+                continue
+
+            content = m.content
+            if self.command_prefix is not None and content.startswith(self.command_prefix):
+                continue
+            if self.phrase is not None and not self._search(content):
+                continue
+
+            yield content
@@ -0,0 +1,223 @@
+""" Markov chain index for the summary plugin.
+
+    The chain keeps a transition table of word -> next word for every
+    stored message, so that generating a summary never has to look
+    through the messages themselves. """
+
+import copy
+import random
+import sys
+from collections import defaultdict
+
+
+link_prefixes = ("http://", "https://")
+
+sample_attempts = 8  # The number of random picks before sampling only from live entries
+
+# Rough memory estimates of a table entry and a table key, used for memory accounting
+entry_bytes = 64
+key_bytes = 200
+
+
+def is_valid_start(word: str):
+    """ Return True if the word can be used to start a summary. """
+    return not word.startswith("@") and not word.startswith("http")
+
+
+class MarkovChain:
+    """ Incrementally maintained transition index of a message corpus.
+
+    Every entry in the tables references the message it came from by a
+    sequence number. Once more than maxlen messages have been added, the
+    oldest messages are considered evicted and their entries are skipped
+    when sampled, until they're all removed by prune().
+
+    Tables are only ever appended to, and prune() replaces them rather than
+    modifying them, so a snapshot() can be generated from in another thread
+    while messages are added. """
+    def __init__(self, order: int=1, maxlen: int=None):
+        assert order in (1, 2), "Only order-1 and order-2 chains are supported."
+
+        self.order = order
+        self.maxlen = maxlen
+        self.count = 0  # The sequence number of the next message added
+        self.pruned_at = 0
+        self.size = 0  # The number of entries in all tables, including evicted ones
+
+        self.starts = []  # List of (first word, ref)
+        self.words = []  # List of (word, ref) for every word in the corpus
+        self.followers = defaultdict(list)  # Lowercase key tuple -> list of (next word, ref)
+        self.ends = defaultdict(list)  # Lowercase key tuple -> list of refs where the key ended the message
+
+    @classmethod
+    def from_messages(cls, messages, order: int=1, maxlen: int=None):
+        """ Create a chain from an iterable of message contents, oldest first. """
+        chain = cls(order=order, maxlen=maxlen)
+        for content in messages:
+            chain.add(content)
+
+        return chain
+
+    @property
+    def oldest(self):
+        """ The sequence number of the oldest message still in the corpus. """
+        if self.maxlen is None:
+            return 0
+
+        return max(self.count - self.maxlen, 0)
+
+    def __len__(self):
+        return self.count - self.oldest
+
+    @property
+    def nbytes(self):
+        """ An estimate of the memory used by the chain in bytes. """
+        return self.size * entry_bytes + (len(self.followers) + len(self.ends)) * key_bytes
+
+    def add(self, content: str, ref: int=None):
+        """ Add a message to the index and return its sequence number.
+
+        :param content: the message content.
+        :param ref: the sequence number to use, if the messages are numbered elsewhere.
+            Sequence numbers must be increasing. """
+        if ref is None:
+            ref = self.count
+        self.count = ref + 1
+
+        # Words are interned as most of them are repeated throughout the corpus
+        words = [sys.intern(w) for w in content.split()]
+        if words:
+            if is_valid_start(words[0]):
+                self.starts.append((words[0], ref))
+                self.size += 1
+            self.words.extend((word, ref) for word in words)
+
+            # Every key is followed by the word after it, and the keys of the last word end the message
+            lowered = [sys.intern(w.lower()) for w in words]
+            last = len(words) - 1
+            for i, word in enumerate(lowered):
+                keys = [(word,)] if i == 0 or self.order == 1 else [(word,), (lowered[i - 1], word)]
+
+                self.size += len(keys) + 1
+                for key in keys:
+                    if i < last:
+                        self.followers[key].append((words[i + 1], ref))
+                    else:
+                        self.ends[key].append(ref)
+
+        # Remove evicted entries once the stale entries could make up a full corpus
+        if self.maxlen is not None and self.oldest - self.pruned_at >= self.maxlen:
+            self.prune()
+
+        return ref
+
+    def prune(self):
+        """ Remove every entry referencing an evicted message. """
+        oldest = self.oldest
+        self.starts = [e for e in self.starts if e[1] >= oldest]
+        self.words = [e for e in self.words if e[1] >= oldest]
+
+        followers, ends = defaultdict(list), defaultdict(list)
+        for key, entries in self.followers.items():
+            entries = [e for e in entries if e[1] >= oldest]
+            if entries:
+                followers[key] = entries
+        for key, entries in self.ends.items():
+            entries = [e for e in entries if e >= oldest]
+            if entries:
+                ends[key] = entries
+        self.followers, self.ends = followers, ends
+
+        self.pruned_at = oldest
+        self.size = len(self.starts) + len(self.words) + sum(len(entries) for entries in self.followers.values()) + \
+            sum(len(entries) for entries in self.ends.values())
+
+    def snapshot(self):
+        """ Return a copy of the chain as it is now. The copy shares its tables
+        with the chain and ignores any message added later. """
+        return copy.copy(self)
+
+    def _sample(self, entries: list, ref=lambda e: e[1]):
+        """ Return a random live entry from the list, or None when there are no
+        live entries. Entries added after a snapshot are not live. """
+        oldest, count = self.oldest, self.count
+        for _ in range(sample_attempts):
+            entry = random.choice(entries)
+            if oldest <= ref(entry) < count:
+                return entry
+
+        # Most entries are evicted, so pick from the live ones
+        entries = [e for e in entries if oldest <= ref(e) < count]
+        return random.choice(entries) if entries else None
+
+    def _transition(self, key: tuple):
+        """ Sample a transition from the given key. Returns a tuple of
+        (found, next word) where next word is None when the message ended. """
+        followers = self.followers.get(key)
+        ends = self.ends.get(key)
+        follower = self._sample(followers) if followers else None
+        end = self._sample(ends, ref=lambda e: e) if ends else None
+
+        if follower is None and end is None:
+            return False, None
+
+        # Prefer continuing the sentence, but end it every now and then
+        if follower is None or (end is not None and random.randint(0, 5) == 0):
+            return True, None
+
+        return True, follower[0]
+
+    def _next_word(self, imitated: list):
+        """ Find the next word from the highest order key with any transitions. """
+        for n in range(min(self.order, len(imitated)), 0, -1):
+            key = tuple(w.lower() for w in imitated[-n:])
+            found, word = self._transition(key)
+            if found:
+                return found, word, bool(self.followers.get(key))
+
+        return False, None, False
+
+    def random_word(self):
+        """ Return a random word in the corpus. """
+        entry = self._sample(self.words) if self.words else None
+        return entry[0] if entry else None
+
+    def generate(self, coherent: bool=False):
+        """ Generate some kind of markov chain that somehow works with discord.
+        I found this makes better results than markovify would.
+
+        :param coherent: never end the summary before reaching the end of a message.
+        :returns: str or None when there are no words to start with. """
+        start = self._sample(self.starts) if self.starts else None
+        if start is None:
+            return None
+
+        imitated = [start[0]]
+        while True:
+            found, word, has_followers = self._next_word(imitated)
+
+            if word is not None:
+                imitated.append(word)
+                continue
+
+            if found:
+                # Have the chance of breaking be 1/4 at start and 1/1 when imitated approaches 150 words
+                # unless the entire summary should be coherent
+                chance = 0 if coherent else int(-0.02 * len(imitated) + 4)
+                chance = chance if chance >= 0 else 0
+
+                if random.randint(0, chance) == 0:
+                    break
+
+            # Add a random word if the last word never continues a message
+            if not has_followers:
+                word = self.random_word()
+                if word is None:
+                    break
+
+                imitated.append(word)
+
+        # Remove links after, because you know
+        imitated = [s for s in imitated if not any(p in s for p in link_prefixes)]
+
+        return " ".join(imitated)
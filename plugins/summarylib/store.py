@@ -0,0 +1,385 @@
+""" Compact message storage for the summary plugin.
+
+    Messages are stored as plain records in array-backed ring buffers,
+    one corpus per channel, and corpora are evicted from least recently
+    used whenever the total memory exceeds the budget.
+
+    Every corpus can be persisted to an append-only file of records,
+    each being a fixed size header followed by the UTF-8 content. The
+    file is rewritten with only the stored records once it holds more
+    than twice the capacity. """
+
+import os
+import struct
+import sys
+import time
+from array import array
+from collections import OrderedDict
+
+from .markov import MarkovChain
+from .filters import MessageFilter
+
+
+# Rough memory estimate of the fixed part of a record: two ids, a timestamp, a bot flag and a list slot
+record_bytes = 8 + 8 + 8 + 1 + 8
+
+max_views = 8  # The maximum number of filtered views cached per corpus
+
+# Header of a persisted record: id, author id, timestamp, bot flag and the length of the content in bytes
+record_header = struct.Struct("<QQd?I")
+
+
+def pack_record(id: int, author_id: int, bot: bool, timestamp: float, content: str):
+    """ Return the persisted bytes of a record. """
+    content_bytes = content.encode("utf-8")
+    return record_header.pack(id, author_id, timestamp, bot, len(content_bytes)) + content_bytes
+
+
+def unpack_records(data: bytes):
+    """ Unpack every record in the data. An incomplete record at the end,
+    for instance after a crash, is ignored.
+
+    :returns: tuple of (list of (id, author_id, bot, timestamp, content), the number of bytes unpacked). """
+    records, offset = [], 0
+    while offset + record_header.size <= len(data):
+        id, author_id, timestamp, bot, length = record_header.unpack_from(data, offset)
+        start = offset + record_header.size
+        if start + length > len(data):
+            break
+
+        records.append((id, author_id, bot, timestamp, data[start:start + length].decode("utf-8", errors="replace")))
+        offset = start + length
+
+    return records, offset
+
+
+def load_records(path: str, capacity: int):
+    """ Load the newest capacity records from a file, oldest first. Records
+    that are not newer than the previous one are skipped. When the file holds
+    more than twice the capacity, it is rewritten with only the loaded records.
+
+    :returns: tuple of (list of record tuples, the number of records left in the file). """
+    if not os.path.exists(path):
+        return [], 0
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    unpacked, size = unpack_records(data)
+    records, last_id = [], 0
+    for record in unpacked:
+        if record[0] > last_id:
+            records.append(record)
+            last_id = record[0]
+
+    # Compact the file when most of it has been evicted
+    if len(records) > capacity * 2:
+        records = records[-capacity:]
+        rewrite_records(path, records)
+
+    # Remove any incomplete record so that we can keep appending to the file
+    elif size < len(data):
+        with open(path, "r+b") as f:
+            f.truncate(size)
+
+    return records[-capacity:], len(records)
+
+
+def rewrite_records(path: str, records):
+    """ Replace a file with the given records.
+
+    :param records: an iterable of record tuples. """
+    with open(path + ".tmp", "wb") as f:
+        f.write(b"".join(pack_record(*record) for record in records))
+    os.replace(path + ".tmp", path)
+
+
+def write_unsaved(unsaved: list):
+    """ Write unsaved data to files. This is file I/O, so run it in an executor.
+
+    :param unsaved: list of (path, data), where bytes are appended to the file
+        and a MessageBuffer replaces the file with its records. """
+    for path, data in unsaved:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(data, MessageBuffer):
+            rewrite_records(path, ((m.id, m.author_id, m.bot, m.timestamp, m.content) for m in data))
+        else:
+            with open(path, "ab") as f:
+                f.write(data)
+
+
+class StoredMessage:
+    """ A compact record of a message. """
+    __slots__ = ("id", "author_id", "bot", "timestamp", "content")
+
+    def __init__(self, id: int, author_id: int, bot: bool, timestamp: float, content: str):
+        self.id = id
+        self.author_id = author_id
+        self.bot = bot
+        self.timestamp = timestamp
+        self.content = content
+
+    def __repr__(self):
+        return "<StoredMessage id={0.id} author_id={0.author_id} content={0.content!r}>".format(self)
+
+
+class MessageBuffer:
+    """ Ring buffer of messages stored in parallel arrays.
+
+    Every appended message is given an increasing sequence number. When the
+    buffer is full, appending overwrites the oldest message. """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.ids = array("Q")
+        self.author_ids = array("Q")
+        self.timestamps = array("d")
+        self.bots = bytearray()
+        self.contents = []
+
+        self.start = 0  # The array index of the oldest message
+        self.count = 0  # The sequence number of the next message appended
+        self.content_bytes = 0
+
+    def __len__(self):
+        return len(self.contents)
+
+    @property
+    def first_seq(self):
+        """ The sequence number of the oldest message in the buffer. """
+        return self.count - len(self)
+
+    @property
+    def last_id(self):
+        """ The id of the newest message, or None if the buffer is empty. """
+        if not self.contents:
+            return None
+
+        return self.ids[(self.start + len(self) - 1) % len(self)]
+
+    @property
+    def nbytes(self):
+        """ An estimate of the memory used by the buffer in bytes. """
+        return len(self) * record_bytes + self.content_bytes
+
+    def append(self, id: int, author_id: int, bot: bool, timestamp: float, content: str):
+        """ Append a message and return its sequence number. """
+        content = sys.intern(content)
+
+        if len(self) < self.capacity:
+            self.ids.append(id)
+            self.author_ids.append(author_id)
+            self.timestamps.append(timestamp)
+            self.bots.append(bot)
+            self.contents.append(content)
+        else:
+            # Overwrite the oldest message
+            i = self.start
+            self.content_bytes -= sys.getsizeof(self.contents[i])
+            self.ids[i] = id
+            self.author_ids[i] = author_id
+            self.timestamps[i] = timestamp
+            self.bots[i] = bot
+            self.contents[i] = content
+            self.start = (i + 1) % self.capacity
+
+        self.content_bytes += sys.getsizeof(content)
+        seq = self.count
+        self.count += 1
+        return seq
+
+    def copy(self):
+        """ Return a copy of the buffer, which is unaffected by later appends. """
+        buffer = MessageBuffer(self.capacity)
+        buffer.ids = self.ids[:]
+        buffer.author_ids = self.author_ids[:]
+        buffer.timestamps = self.timestamps[:]
+        buffer.bots = self.bots[:]
+        buffer.contents = self.contents[:]
+        buffer.start, buffer.count, buffer.content_bytes = self.start, self.count, self.content_bytes
+        return buffer
+
+    def _record(self, i: int):
+        return StoredMessage(self.ids[i], self.author_ids[i], bool(self.bots[i]), self.timestamps[i], self.contents[i])
+
+    def __getitem__(self, index: int):
+        """ Return the record at the given index, where 0 is the oldest message. """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("buffer index out of range")
+
+        return self._record((self.start + index) % len(self))
+
+    def __iter__(self):
+        """ Iterate over every record, oldest first. """
+        for index in range(len(self)):
+            yield self._record((self.start + index) % len(self))
+
+
+class Corpus:
+    """ The stored messages of a channel along with their markov chain. """
+    def __init__(self, channel_id: str, capacity: int, order: int=1, path: str=None):
+        """
+        :param path: the file to persist messages in, or None. """
+        self.channel_id = channel_id
+        self.capacity = capacity
+        self.order = order
+        self.path = path
+        self.last_used = time.monotonic()
+        self.synced = False  # Whether the corpus has every message since it was loaded
+        self.pending = None  # A list of messages received while syncing, otherwise None
+        self.persisted = 0  # The number of records in the file, including unsaved records
+        self.reset()
+
+    def reset(self):
+        """ Remove every message from the corpus. Messages that are not yet
+        persisted are removed as well. """
+        self.buffer = MessageBuffer(self.capacity)
+        self.chain = MarkovChain(order=self.order, maxlen=self.capacity)
+        self.unsaved = bytearray()
+        self.views = OrderedDict()  # Filter keys -> (buffer count when filtered, markov chain)
+
+    def __len__(self):
+        return len(self.buffer)
+
+    @property
+    def nbytes(self):
+        """ An estimate of the memory used by the corpus in bytes. """
+        return self.buffer.nbytes + self.chain.nbytes + len(self.unsaved) + \
+            sum(chain.nbytes for _, chain in self.views.values())
+
+    def append(self, id: int, author_id: int, bot: bool, timestamp: float, content: str, index: bool=True,
+               save: bool=True):
+        """ Store a message, and add it to the markov chain unless index is False.
+        The message is persisted on the next save unless save is False. """
+        seq = self.buffer.append(id, author_id, bot, timestamp, content)
+        if index:
+            self.chain.add(content, ref=seq)
+        if save and self.path is not None:
+            self.unsaved += pack_record(id, author_id, bot, timestamp, content)
+            self.persisted += 1
+
+    def get_view(self, message_filter: MessageFilter):
+        """ Return the cached markov chain of the messages passing the filter,
+        or None when it's not cached or new messages were stored since.
+        Filters only excluding commands return the corpus' own markov chain. """
+        if message_filter.is_default:
+            return self.chain
+
+        key = message_filter.key
+        if key not in self.views:
+            return None
+
+        count, chain = self.views[key]
+        if count != self.buffer.count:
+            del self.views[key]
+            return None
+
+        self.views.move_to_end(key)
+        return chain
+
+    def set_view(self, message_filter: MessageFilter, count: int, chain: MarkovChain):
+        """ Cache the markov chain of the messages passing the filter.
+
+        :param count: the buffer's count when the messages were filtered. """
+        if count != self.buffer.count:
+            return
+
+        self.views[message_filter.key] = (count, chain)
+        self.views.move_to_end(message_filter.key)
+        while len(self.views) > max_views:
+            self.views.popitem(last=False)
+
+    def take_unsaved(self):
+        """ Return the unsaved data as (path, data), and consider it saved. When the
+        file would hold more than twice the capacity, data is a copy of the buffer
+        to replace the file with, otherwise the bytes to append. """
+        if self.persisted > self.capacity * 2:
+            self.unsaved, self.persisted = bytearray(), len(self.buffer)
+            return self.path, self.buffer.copy()
+
+        data, self.unsaved = bytes(self.unsaved), bytearray()
+        return self.path, data
+
+
+class CorpusStore:
+    """ Least recently used collection of corpora with a memory budget. """
+    def __init__(self, budget: int, capacity: int, order: int=1, path: str=None):
+        """
+        :param budget: the maximum memory of every corpus combined, in bytes.
+        :param capacity: the maximum number of messages in each corpus.
+        :param order: the order of each corpus' markov chain.
+        :param path: the directory to persist corpora in, or None. """
+        self.budget = budget
+        self.capacity = capacity
+        self.order = order
+        self.path = path
+        self.corpora = OrderedDict()
+        self.evicted_unsaved = []  # The unsaved data of evicted corpora, see take_unsaved()
+
+    def __contains__(self, channel_id: str):
+        return channel_id in self.corpora
+
+    def __len__(self):
+        return len(self.corpora)
+
+    @property
+    def nbytes(self):
+        """ An estimate of the memory used by every corpus in bytes. """
+        return sum(corpus.nbytes for corpus in self.corpora.values())
+
+    def peek(self, channel_id: str):
+        """ Return the corpus of a channel without marking it as used, or None. """
+        return self.corpora.get(channel_id)
+
+    def get(self, channel_id: str):
+        """ Return the corpus of a channel and mark it as the most recently used.
+        The corpus is created when it does not exist. """
+        corpus = self.corpora.get(channel_id)
+        if corpus is None:
+            path = os.path.join(self.path, channel_id + ".bin") if self.path is not None else None
+            corpus = self.corpora[channel_id] = Corpus(channel_id, self.capacity, self.order, path)
+        else:
+            self.corpora.move_to_end(channel_id)
+
+        corpus.last_used = time.monotonic()
+        return corpus
+
+    def remove(self, channel_id: str):
+        """ Remove the corpus of a channel. """
+        self.corpora.pop(channel_id, None)
+
+    def take_unsaved(self):
+        """ Return the unsaved data of every corpus, including evicted corpora,
+        as a list of (path, data) to be written with write_unsaved(). """
+        unsaved, self.evicted_unsaved = self.evicted_unsaved, []
+        unsaved.extend(corpus.take_unsaved() for corpus in self.corpora.values() if corpus.unsaved)
+        return unsaved
+
+    def enforce_budget(self):
+        """ Evict the least recently used corpora until we're within the budget.
+        The most recently used corpus and corpora being synced are never evicted.
+        The unsaved data of evicted corpora is kept until the next take_unsaved().
+
+        :returns: list of evicted channel ids. """
+        evicted = []
+        total = self.nbytes
+
+        for channel_id, corpus in list(self.corpora.items())[:-1]:
+            if total <= self.budget:
+                break
+            if corpus.pending is not None:
+                continue
+
+            del self.corpora[channel_id]
+            if corpus.unsaved:
+                self.evicted_unsaved.append(corpus.take_unsaved())
+
+            total -= corpus.nbytes
+            evicted.append(channel_id)
+
+        return evicted
+
+    def usage(self):
+        """ Return a list of every corpus sorted by memory usage, largest first. """
+        return sorted(self.corpora.values(), key=lambda corpus: corpus.nbytes, reverse=True)